@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+__author__ = 'hlsky'
+
+
+'''
+description: transwarp.db benchmark suite, run against a sqlite3 stand-in driver
+
+usage:
+    python bench.py                                # 运行全部benchmark
+    python bench.py -k select                      # 只运行名字包含select的benchmark
+    python bench.py --latency 0.0005               # 每条语句模拟0.5ms网络延迟
+    python bench.py --save bench_baseline.json     # 保存结果作为baseline
+    python bench.py --compare bench_baseline.json  # 与baseline比较，ops/sec下降超过tolerance时返回1
+
+baseline不提交到仓库：ops/sec取决于机器，只有同一台机器上的结果才可比较。
+检查一个改动时，先在改动前的代码上--save，再在改动后的代码上--compare。
+'''
+
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+import multiprocessing
+from timeit import default_timer as timer
+
+from www.transwarp import db
+
+
+# sqlite3 stand-in: 把db模块使用的'%s'占位符改回sqlite的'?'，并按需模拟网络延迟
+class _Cursor(object):
+    def __init__(self, cursor, latency):
+        self._cursor = cursor
+        self._latency = latency
+
+    def execute(self, sql, args=()):
+        if self._latency:
+            time.sleep(self._latency)
+        self._cursor.execute(sql.replace('%s', '?'), tuple(args))
+
+    def executemany(self, sql, seq_of_args):
+        if self._latency:
+            time.sleep(self._latency)
+        self._cursor.executemany(sql.replace('%s', '?'), [tuple(a) for a in seq_of_args])
+
+    def __getattr__(self, key):
+        return getattr(self._cursor, key)
+
+
+class _Connection(object):
+    def __init__(self, path, latency=0.0, connect_latency=0.0):
+        if connect_latency:
+            time.sleep(connect_latency)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._latency = latency
+
+    def cursor(self, **kw):
+        return _Cursor(self._conn.cursor(), self._latency)
+
+    def __getattr__(self, key):
+        return getattr(self._conn, key)
+
+
+def init_engine(path, latency=0.0, connect_latency=0.0, **kw):
+    db.engine = db._Engine(lambda: _Connection(path, latency, connect_latency), **kw)
+
+
+def prepare(path, rows):
+    conn = sqlite3.connect(path)
+    conn.execute('create table bench (id integer primary key, uid int, amount real, note text)')
+    conn.execute('create table bench_w (id integer primary key, v int)')
+    conn.executemany('insert into bench values (?, ?, ?, ?)',
+                     ((i, i % 100, i * 0.01, 'note-%d' % i) for i in xrange(rows)))
+    conn.commit()
+    conn.close()
+
+
+# benchmark注册表：name -> (setup, 最少运行次数)
+BENCHMARKS = []
+
+
+def benchmark(name, min_iterations=3):
+    """
+    注册benchmark，被装饰的函数返回一次操作的callable，或(callable, 每次调用的操作数)
+    """
+    def decorator(func):
+        BENCHMARKS.append((name, func, min_iterations))
+        return func
+    return decorator
+
+
+@benchmark('select 1 row')
+def b_select_1(opts):
+    return lambda: db.select('select * from bench where id = ?', 1)
+
+
+@benchmark('select 1k rows')
+def b_select_1k(opts):
+    return lambda: db.select('select * from bench where id < ?', 1000)
+
+
+@benchmark('select 100k rows')
+def b_select_100k(opts):
+    return lambda: db.select('select * from bench where id < ?', 100000)
+
+
+@benchmark('select_one')
+def b_select_one(opts):
+    return lambda: db.select_one('select * from bench where id = ?', 7)
+
+
+@benchmark('select_int')
+def b_select_int(opts):
+    return lambda: db.select_int('select count(*) from bench where id < ?', 100)
+
+
+@benchmark('select_scalar')
+def b_select_scalar(opts):
+    return lambda: db.select_scalar('select count(*) from bench where id < ?', 100)
+
+
+@benchmark('select_column 1k ids')
+def b_select_column(opts):
+    return lambda: db.select_column('select id from bench where id < ?', 1000)
+
+
+@benchmark('insert')
+def b_insert(opts):
+    ids = _next_ids()
+    return lambda: db.insert('bench_w', id=next(ids), v=0)
+
+
+@benchmark('update')
+def b_update(opts):
+    return lambda: db.update('update bench set uid = uid + 1 where id = ?', 3)
+
+
+@benchmark('nested transaction')
+def b_transaction(opts):
+    def op():
+        with db.transaction():
+            db.update('update bench set uid = uid + 1 where id = ?', 5)
+            with db.transaction():
+                db.select_one('select * from bench where id = ?', 5)
+    return op
+
+
+@benchmark('stream 100k rows')
+def b_stream(opts):
+    def op():
+        for row in db.stream('select * from bench where id < ?', 100000, batch=1000):
+            pass
+    return op
+
+
+@benchmark('select + pivot 100k rows')
+def b_select_pivot(opts):
+    def op():
+        result = db.select('select * from bench where id < ?', 100000)
+        return dict((name, [r[name] for r in result]) for name in ('id', 'uid', 'amount', 'note'))
+    return op
+
+
+@benchmark('select_columns 100k rows')
+def b_select_columns(opts):
+    return lambda: db.select_columns('select * from bench where id < ?', 100000)
+
+
+@benchmark('connection setup (pooled)')
+def b_connect_pooled(opts):
+    def op():
+        db.engine.release(db.engine.connect())
+    return op
+
+
+@benchmark('connection setup (no pool)')
+def b_connect_unpooled(opts):
+    init_engine(opts.path, opts.latency, opts.connect_latency, pool_size=0)
+    return b_connect_pooled(opts)
+
+
+@benchmark('select 1 row, 8 threads')
+def b_threads(opts, threads=8, per_thread=200):
+    def worker():
+        for i in xrange(per_thread):
+            db.select('select * from bench where id = ?', i)
+
+    def op():
+        ts = [threading.Thread(target=worker) for i in range(threads)]
+        for t in ts:
+            t.start()
+        for t in ts:
+            t.join()
+    return op, threads * per_thread
+
+
+def _next_ids():
+    # 各benchmark共用同一个数据库文件，id接着已有的最大值
+    return iter(xrange(db.select_int('select coalesce(max(id), 0) + 1 from bench_w'), sys.maxint))
+
+
+def _threaded_inserts(threads, per_thread):
+    ids = _next_ids()
+    lock = threading.Lock()
+
+    def worker():
+        for i in xrange(per_thread):
+            with lock:
+                id = next(ids)
+            db.insert('bench_w', id=id, v=0)
+
+    def op():
+        ts = [threading.Thread(target=worker) for i in range(threads)]
+        for t in ts:
+            t.start()
+        for t in ts:
+            t.join()
+    return op, threads * per_thread
+
+
+@benchmark('insert, 8 threads')
+def b_insert_threads(opts):
+    return _threaded_inserts(8, 50)
+
+
+@benchmark('insert, 8 threads, group commit')
+def b_insert_group_commit(opts):
+    db.enable_group_commit()
+    return _threaded_inserts(8, 50)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(int(p * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def run_one(name, setup, min_iterations, opts):
+    """
+    在子进程中运行，每个benchmark的峰值内存互不影响
+    """
+    init_engine(opts.path, opts.latency, opts.connect_latency)
+    op = setup(opts)
+    ops_per_call = 1
+    if isinstance(op, tuple):
+        op, ops_per_call = op
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    op()
+    latencies = []
+    start = timer()
+    while len(latencies) < min_iterations or timer() - start < opts.duration:
+        t = timer()
+        op()
+        latencies.append((timer() - t) / ops_per_call)
+    total = timer() - start
+    latencies.sort()
+    return dict(ops=len(latencies) * ops_per_call,
+                ops_per_sec=len(latencies) * ops_per_call / total,
+                p50_ms=percentile(latencies, 0.50) * 1000,
+                p95_ms=percentile(latencies, 0.95) * 1000,
+                p99_ms=percentile(latencies, 0.99) * 1000,
+                peak_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss)
+
+
+def _child(queue, name, setup, min_iterations, opts):
+    logging.disable(logging.CRITICAL)
+    try:
+        queue.put(run_one(name, setup, min_iterations, opts))
+    except Exception as e:
+        queue.put(dict(error='%s: %s' % (e.__class__.__name__, e)))
+
+
+def run(opts):
+    results = {}
+    print '%-30s %10s %12s %9s %9s %9s %10s' % ('benchmark', 'ops', 'ops/sec', 'p50 ms', 'p95 ms', 'p99 ms', 'peak KB')
+    for name, setup, min_iterations in BENCHMARKS:
+        if opts.keyword and opts.keyword not in name:
+            continue
+        queue = multiprocessing.Queue()
+        p = multiprocessing.Process(target=_child, args=(queue, name, setup, min_iterations, opts))
+        p.start()
+        r = queue.get()
+        p.join()
+        results[name] = r
+        if 'error' in r:
+            print '%-30s %s' % (name, r['error'])
+            continue
+        print '%-30s %10d %12.1f %9.3f %9.3f %9.3f %10d' % (
+            name, r['ops'], r['ops_per_sec'], r['p50_ms'], r['p95_ms'], r['p99_ms'], r['peak_kb'])
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: 退化的benchmark列表
+    """
+    regressions = []
+    for name, r in sorted(results.iteritems()):
+        base = baseline.get(name)
+        if not base or 'error' in r or 'error' in base:
+            continue
+        ratio = r['ops_per_sec'] / base['ops_per_sec']
+        if ratio < 1 - tolerance:
+            regressions.append(name)
+            print 'REGRESSION %-30s %10.1f -> %10.1f ops/sec (%+.0f%%)' % (
+                name, base['ops_per_sec'], r['ops_per_sec'], (ratio - 1) * 100)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='transwarp.db benchmark suite')
+    parser.add_argument('-k', dest='keyword', help='only run benchmarks whose name contains KEYWORD')
+    parser.add_argument('--rows', type=int, default=100000, help='rows in the bench table')
+    parser.add_argument('--duration', type=float, default=1.0, help='minimum seconds per benchmark')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated seconds per statement')
+    parser.add_argument('--connect-latency', type=float, default=0.002, help='simulated seconds per connect')
+    parser.add_argument('--save', metavar='JSON', help='write results to JSON')
+    parser.add_argument('--compare', metavar='JSON', help='compare with baseline JSON, exit 1 on regression')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed ops/sec drop against baseline')
+    opts = parser.parse_args(argv)
+
+    opts.path = tempfile.mktemp(suffix='.db')
+    try:
+        prepare(opts.path, opts.rows)
+        results = run(opts)
+    finally:
+        os.remove(opts.path)
+    if opts.save:
+        with open(opts.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if opts.compare:
+        with open(opts.compare) as f:
+            if compare(results, json.load(f), opts.tolerance):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
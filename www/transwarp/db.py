@@ -8,20 +8,50 @@ description: database operation module
 '''
 
 import threading
-import mysql.connector
 import logging
 import time
 import functools
 import traceback
+import collections
+import itertools
+import array
+import re
+import Queue
+import bisect
+import random
+import atexit
+import zlib
+import sys
+import json
+import base64
+import datetime
+import decimal
+import csv
+import gzip
+import cStringIO
+import os
+import tempfile
+
+try:
+    import mysql.connector
+except ImportError:
+    mysql = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
 
 # db.py
 
-# logging config
-logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s  [%(levelname)s] [%(filename)s] [line:%(lineno)d]  %(message)s',
-                    datefmt='%d.%b.%Y %H:%M:%S',
-                    # filename='myapp.log',
-                    filemode='w')
+# 模块日志：不在import时修改全局logging配置，由应用自行配置handler和级别
+logger = logging.getLogger('transwarp.db')
+logger.addHandler(logging.NullHandler())
 
 
 class Dict(dict):
@@ -68,6 +98,267 @@ class Dict(dict):
         self[key] = value
 
 
+# 结果集共享的列结构
+class _Schema(object):
+    """
+    一个结果集所有行共享的列名->下标映射
+    """
+    __slots__ = ('names', 'index')
+
+    def __init__(self, names):
+        self.names = tuple(names)
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+
+    def row(self, values):
+        r = _new_row(Row)
+        _set_schema(r, self)
+        _set_values(r, values)
+        _set_extra(r, None)
+        return r
+
+    def rows(self, seq):
+        return [self.row(values) for values in seq]
+
+
+class Row(object):
+    """
+    紧凑的查询结果行：列名映射由整个结果集共享，每行只保存驱动返回的values，
+    同样支持x.y和x['y']访问。
+    >>> schema = _Schema(('id', 'name'))
+    >>> r = schema.row((1, 'Bob'))
+    >>> r.name, r['id'], len(r)
+    ('Bob', 1, 2)
+    >>> r.name = 'Tom'
+    >>> r.extra = 100
+    >>> r.as_dict() == dict(id=1, name='Tom', extra=100)
+    True
+    >>> sorted(r.keys())
+    ['extra', 'id', 'name']
+    >>> r.empty
+    Traceback (most recent call last):
+        ...
+    AttributeError: 'Row' object has no attribute 'empty'
+    >>> schema.row((2, 'Alice'))['empty']
+    Traceback (most recent call last):
+        ...
+    KeyError: 'empty'
+    """
+    __slots__ = ('_schema', '_values', '_extra')
+
+    def __getitem__(self, key):
+        i = self._schema.index.get(key)
+        if i is not None:
+            return self._values[i]
+        if self._extra is not None:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(r"'Row' object has no attribute '%s'" % key)
+
+    def __setitem__(self, key, value):
+        i = self._schema.index.get(key)
+        if i is None:
+            if self._extra is None:
+                _set_extra(self, {})
+            self._extra[key] = value
+            return
+        if not isinstance(self._values, list):
+            _set_values(self, list(self._values))
+        self._values[i] = value
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self._schema.index or (self._extra is not None and key in self._extra)
+
+    def __len__(self):
+        return len(self._values) + (len(self._extra) if self._extra else 0)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        keys = list(self._schema.names)
+        if self._extra:
+            keys.extend(self._extra.keys())
+        return keys
+
+    def values(self):
+        values = list(self._values)
+        if self._extra:
+            values.extend(self._extra.values())
+        return values
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def as_dict(self):
+        """
+        :return: 与旧版本结果相同的Dict
+        """
+        d = Dict(self._schema.names, self._values)
+        if self._extra:
+            d.update(self._extra)
+        return d
+
+    def __eq__(self, other):
+        if isinstance(other, Row):
+            other = other.as_dict()
+        return self.as_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+    def __reduce__(self):
+        return _load_row, (self._schema.names, tuple(self._values), self._extra)
+
+
+_new_row = object.__new__
+_set_schema = Row._schema.__set__
+_set_values = Row._values.__set__
+_set_extra = Row._extra.__set__
+
+
+def _row_maker(names):
+    """
+    :param names: 结果集列名
+    :return: 把驱动返回的values转换为一行结果的函数，engine.compact_rows为False时返回Dict
+    """
+    if engine is None or engine.compact_rows:
+        return _Schema(names).row
+    return lambda values: Dict(names, values)
+
+
+def _load_row(names, values, extra):
+    r = _Schema(names).row(values)
+    if extra:
+        _set_extra(r, dict(extra))
+    return r
+
+
+# sql日志配置：mode为None(关闭)、'all'、'slow'(只记录慢查询和出错的语句)或'sample'(抽样加慢查询)
+_sql_log_mode = None
+_slow_threshold = 0.1
+_sample_rate = 0.01
+
+
+def set_sql_log(mode='slow', slow_threshold=0.1, sample_rate=0.01):
+    """
+    配置sql日志，默认关闭。日志写入logger 'transwarp.db'，慢查询为WARNING，其余为INFO
+    :param mode: None, 'all', 'slow' 或 'sample'
+    :param slow_threshold: 慢查询阈值(秒)
+    :param sample_rate: 'sample'模式下非慢查询的抽样比例
+    :return: None
+    """
+    global _sql_log_mode, _slow_threshold, _sample_rate
+    if mode not in (None, 'all', 'slow', 'sample'):
+        raise ValueError('Invalid sql log mode: %r' % mode)
+    _sql_log_mode, _slow_threshold, _sample_rate = mode, slow_threshold, sample_rate
+
+
+class _QueueHandler(logging.Handler):
+    """
+    非阻塞的日志handler：调用线程只把record放入队列，由后台线程交给target输出；
+    队列满时丢弃并计数，不阻塞查询
+    """
+    def __init__(self, target, maxsize=10000):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.queue = Queue.Queue(maxsize)
+        self.dropped = 0
+        self._start()
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name='transwarp-db-log')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def after_fork(self):
+        """
+        fork后子进程中没有后台线程，队列的锁也可能处于加锁状态，重建两者
+        """
+        self.queue = Queue.Queue(self.queue.maxsize)
+        self.createLock()
+        self._start()
+
+    def emit(self, record):
+        if record.exc_info:
+            # traceback对象不能跨线程延后格式化
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            try:
+                self.target.handle(record)
+            except Exception:
+                self.target.handleError(record)
+
+    def close(self):
+        if self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join(5)
+        self.target.close()
+        logging.Handler.close(self)
+
+
+def use_queue_handler(handler, maxsize=10000):
+    """
+    通过后台线程把'transwarp.db'的日志交给handler输出，日志I/O不再阻塞查询线程
+    :param handler: 实际输出日志的handler
+    :param maxsize: 队列长度，满时丢弃日志
+    :return: _QueueHandler
+    """
+    qh = _QueueHandler(handler, maxsize)
+    logger.addHandler(qh)
+    logger.propagate = False
+    atexit.register(qh.close)
+    return qh
+
+
+def _log_sql(sql, args, elapsed, rows, failed):
+    mode = _sql_log_mode
+    slow = elapsed >= _slow_threshold
+    if not (slow or failed or mode == 'all' or (mode == 'sample' and random.random() < _sample_rate)):
+        return
+    level = logging.WARNING if slow or failed else logging.INFO
+    if logger.isEnabledFor(level):
+        logger.log(level, '[SQL] %.3fms rows=%s%s %s Args: %r', elapsed * 1000, rows,
+                   ' failed' if failed else '', sql, args)
+
+
 # profile func
 def _profiling(start, sql=''):
     """
@@ -77,10 +368,10 @@ def _profiling(start, sql=''):
     :return: none
     """
     t = time.time() - start
-    if t > 0.1:
-        logging.warning("[PROFILING] [DB] %s: %s" % (t, sql))
+    if t > _slow_threshold:
+        logger.warning("[PROFILING] [DB] %s: %s", t, sql)
     else:
-        logging.info("[PROFILING] [DB] %s: %s" % (t, sql))
+        logger.debug("[PROFILING] [DB] %s: %s", t, sql)
 
 
 def exception_logging(etype, value, tb, func_name=''):
@@ -92,17 +383,17 @@ def exception_logging(etype, value, tb, func_name=''):
     :param func_name: 错误打印函数名
     :return: None
     """
-    if tb:
+    if tb and logger.isEnabledFor(logging.INFO):
         err_info = ''.join(['Traceback: '] + traceback.format_tb(tb))
         err_info = err_info.replace('\n', ' ')
-        logging.info(err_info)
-    if etype or value:
+        logger.info(err_info)
+    if (etype or value) and logger.isEnabledFor(logging.ERROR):
         func_str = 'in func <' + func_name + '>: ' if func_name else ''
         err_type = func_str + ''.join(traceback.format_exception_only(etype, value))
         # print "funcstr: ", func_str
         err_type = err_type.replace('\n', '')
         # print err_type
-        logging.error(err_type)
+        logger.error(err_type)
 
 
 # raise error object(错误定义对象)
@@ -114,264 +405,2448 @@ class MultiColumnsError(DBError):
     pass
 
 
-# database engine object(数据库引擎对象)
-class _Engine(object):
-    def __init__(self, connect):
-        """
-        :param connect: mysql db connect
-        :return: none
-        """
-        self._connect = connect
+class QueryTimeoutError(DBError):
+    pass
 
-    def connect(self):
-        """
-        :return: pointer of mysql connect
-        """
-        return self._connect()
 
-# global engine object:
-engine = None
+class PoolTimeoutError(DBError):
+    pass
 
 
-def create_engine(user, password, database, host='127.0.0.1', port=3306, **kw):
+# LRU cache(最近最少使用缓存)
+class _LRUCache(object):
     """
-    创建engine连接
-    :param user: database username
-    :param password: database password
-    :param database: database name
-    :param host: host
-    :param port: port
-    :param kw: 其他参数
-    :return: None
+    线程安全的LRU缓存，带命中/未命中/淘汰计数。on_evict在条目被淘汰时以(key, value)调用。
+    >>> c = _LRUCache(2)
+    >>> c.put('a', 1)
+    >>> c.put('b', 2)
+    >>> c.get('a')
+    1
+    >>> c.put('c', 3)
+    >>> c.get('b') is None
+    True
+    >>> s = c.stats()
+    >>> s.hits, s.misses, s.evictions, s.size
+    (1, 1, 1, 2)
     """
-    global engine
-    if engine is not None:
-        raise DBError("Engine is already initialized.")
-    params = dict(user=user, password=password, database=database, host=host, port=port)
-    defaults = dict(use_unicode=True, charset='utf8', collation='utf8_general_ci', autocommit=False)
-    for k, v in defaults.iteritems():
-        params[k] = kw.pop(k, v)
-    params.update(kw)
-    # 使用lambda可以使mysql.connector.connect(**params)整体变为一个回调函数，只有在实际调用时才会运行函数。
-    engine = _Engine(lambda: mysql.connector.connect(**params))
-    # buffered参数：cursor是否立即返回fetch结果（缓存区）
-    params['buffered'] = True
-    # test connection...
-    logging.info('Init mysql engine <%s> ok.' % hex(id(engine)))
+    def __init__(self, capacity, on_evict=None):
+        self.capacity = capacity
+        self._on_evict = on_evict
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
 
-# 数据库底层连接封装
-class _LasyConnection(object):
+    def put(self, key, value):
+        evicted = []
+        with self._lock:
+            self._data.pop(key, None)
+            if self.capacity > 0:
+                self._data[key] = value
+            while len(self._data) > max(self.capacity, 0):
+                evicted.append(self._data.popitem(last=False))
+            self.evictions += len(evicted)
+        if self._on_evict:
+            for k, v in evicted:
+                self._on_evict(k, v)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def resize(self, capacity):
+        self.capacity = capacity
+        evicted = []
+        with self._lock:
+            while len(self._data) > max(capacity, 0):
+                evicted.append(self._data.popitem(last=False))
+            self.evictions += len(evicted)
+        if self._on_evict:
+            for k, v in evicted:
+                self._on_evict(k, v)
+
+    def clear(self):
+        with self._lock:
+            items = self._data.items()
+            self._data.clear()
+        return items
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return Dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    size=len(self._data), capacity=self.capacity)
+
+
+# connection pool(连接池)
+class _ConnectionPool(object):
     """
-    惰性连接封装，仅当需要调用cursor时才连接数据库
+    线程安全的有界连接池。最多保留pool_size条空闲连接，峰值时允许额外建立max_overflow条连接，
+    连接数达到上限时等待pool_timeout秒，超过recycle秒的连接在取出时重建。
+    >>> opened = []
+    >>> class FakeConn(object):
+    ...     def rollback(self):
+    ...         pass
+    ...     def close(self):
+    ...         opened.remove(self)
+    >>> def fake_connect():
+    ...     c = FakeConn()
+    ...     opened.append(c)
+    ...     return c
+    >>> pool = _ConnectionPool(fake_connect, pool_size=1, max_overflow=1, pool_timeout=0.01)
+    >>> c1 = pool.checkout()
+    >>> c2 = pool.checkout()
+    >>> pool.checkout()
+    Traceback (most recent call last):
+        ...
+    PoolTimeoutError: Pool limit of 2 connections reached, timed out after 0.01s.
+    >>> pool.checkin(c2)
+    >>> pool.checkin(c1)
+    >>> len(opened)
+    1
+    >>> pool.checkout() is c2
+    True
+    >>> s = pool.stats()
+    >>> s.in_use, s.idle, s.created, s.timeouts
+    (1, 0, 2, 1)
     """
-    def __init__(self):
-        self.connection = None
+    def __init__(self, connect, pool_size=5, max_overflow=10, pool_timeout=30, recycle=3600):
+        """
+        :param connect: 建立新连接的回调函数
+        :param pool_size: 最多保留的空闲连接数
+        :param max_overflow: 超出pool_size后允许临时建立的连接数
+        :param pool_timeout: 等待可用连接的最长秒数
+        :param recycle: 连接最长存活秒数，<=0表示不回收
+        :return: none
+        """
+        self._connect = connect
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_timeout = pool_timeout
+        self.recycle = recycle
+        self._lock = threading.Condition(threading.Lock())
+        # 空闲连接：(connection, 建立时间)，后进先出，尽量复用热连接
+        self._idle = collections.deque()
+        # 每条连接的附属记录：建立时间、预编译cursor缓存等
+        self._records = {}
+        self._in_use = 0
+        self._created = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait = 0.0
+        self._timeouts = 0
+        # 建立连接的进程，fork后的子进程不能使用父进程的连接
+        self._pid = os.getpid()
+        # 子进程中父进程已取出、还未归还的连接id
+        self._foreign = set()
 
-    def cursor(self):
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            _after_fork()
+            if self._pid != os.getpid():
+                self.reset_after_fork()
+
+    def reset_after_fork(self):
         """
-        只有当需要调用cursor时才会连接数据库
-        :return: None
+        在fork出的子进程中调用：丢弃继承自父进程的全部连接。
+        不关闭这些连接（关闭会在父进程仍在使用的socket上发送QUIT），只保留引用避免被回收。
         """
-        if self.connection is None:
-            conn = engine.connect()
-            # logging.info('open connection <%s>...' % hex(id(connection)))
-            logging.info('[CONNECTION] [OPEN] connection <%s>...' % hex(id(connection)))
-            self.connection = conn
-        return self.connection.cursor()
+        self._lock = threading.Condition(threading.Lock())
+        _inherited.extend(conn for conn, born in self._idle)
+        self._idle.clear()
+        self._foreign = set(self._records.keys())
+        self._records = {}
+        self._in_use = 0
+        self._created = self._checkouts = self._waits = self._timeouts = 0
+        self._wait_time = self._max_wait = 0.0
+        self._pid = os.getpid()
 
-    def commit(self):
-        return self.connection.commit()
+    def _open(self):
+        conn = self._connect()
+        with self._lock:
+            self._records[id(conn)] = Dict(born=time.time(), cursors=None)
+            self._created += 1
+        logger.debug('[POOL] [OPEN] connection <%#x>...', id(conn))
+        return conn
 
-    def rollback(self):
-        return self.connection.rollback()
+    def _close(self, conn):
+        with self._lock:
+            record = self._records.pop(id(conn), None)
+        if record and record.cursors is not None:
+            for sql, cursor in record.cursors.clear():
+                _close_cursor(cursor)
+        logger.debug('[POOL] [CLOSE] connection <%#x>...', id(conn))
+        try:
+            conn.close()
+        except Exception:
+            logger.warning('[POOL] close connection <%#x> failed.', id(conn))
 
-    def cleanup(self):
+    def checkout(self):
         """
-        关闭数据库连接
-        :return: None
+        从连接池中取出一条连接，没有空闲连接时新建，连接数达到上限时等待
+        :return: connection
         """
-        if self.connection:
-            conn = self.connection
-            self.connection = None
-            # logging.info('close connection <%s>...' % hex(id(connection)))
-            logging.info('[CONNECTION] [CLOSE] connection <%s>...' % hex(id(connection)))
-            conn.close()
+        self._check_fork()
+        stale = []
+        start = None
+        try:
+            with self._lock:
+                while True:
+                    now = time.time()
+                    while self._idle:
+                        conn, born = self._idle.pop()
+                        if self.recycle > 0 and now - born > self.recycle:
+                            stale.append(conn)
+                            continue
+                        self._checkout_ok(start, now)
+                        return conn
+                    if self._in_use < self.pool_size + self.max_overflow:
+                        self._checkout_ok(start, now)
+                        break
+                    if start is None:
+                        start = now
+                        self._waits += 1
+                    remaining = start + self.pool_timeout - now
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeoutError('Pool limit of %d connections reached, timed out after %ss.'
+                                               % (self.pool_size + self.max_overflow, self.pool_timeout))
+                    self._lock.wait(remaining)
+        finally:
+            for conn in stale:
+                self._close(conn)
+        # 在锁外建立连接，避免握手期间阻塞其他线程
+        try:
+            return self._open()
+        except:
+            with self._lock:
+                self._in_use -= 1
+                self._lock.notify()
+            raise
 
+    def _checkout_ok(self, start, now):
+        # 调用方须持有self._lock
+        self._in_use += 1
+        self._checkouts += 1
+        if start is not None:
+            waited = now - start
+            self._wait_time += waited
+            self._max_wait = max(self._max_wait, waited)
 
-# 持有数据库连接的上下文对象:
-# threading.local的继承，会对每一个线程生成新的局部变量，即使_db_ctx是全局的
-class _DbCtx(threading.local):
-    def __init__(self):
-        super(_DbCtx, self).__init__()
-        self.connection = None
-        self.transactions = 0
+    def checkin(self, conn, discard=False):
+        """
+        归还连接。归还前回滚未提交的事务，失败或discard=True时直接关闭连接
+        :param conn: checkout取出的连接
+        :param discard: 是否丢弃该连接
+        :return: None
+        """
+        self._check_fork()
+        if self._foreign and id(conn) in self._foreign:
+            # fork前从父进程的连接池取出的连接
+            self._foreign.discard(id(conn))
+            _inherited.append(conn)
+            return
+        if not discard:
+            try:
+                conn.rollback()
+            except Exception:
+                logger.warning('[POOL] reset connection <%#x> failed, discard it.', id(conn))
+                discard = True
+        with self._lock:
+            self._in_use -= 1
+            keep = not discard and len(self._idle) < self.pool_size
+            if keep:
+                self._idle.append((conn, self.record(conn).born))
+            self._lock.notify()
+        if not keep:
+            self._close(conn)
 
-    def is_init(self):
+    def record(self, conn):
         """
-        判断数据库是否初始化（建立连接）
-        :return:
+        :param conn: 由本连接池建立的连接
+        :return: 该连接的附属记录Dict(born, cursors)
         """
-        return self.connection is not None
+        record = self._records.get(id(conn))
+        if record is None:
+            record = self._records.setdefault(id(conn), Dict(born=time.time(), cursors=None))
+        return record
 
-    def init(self):
+    def prewarm(self, n):
         """
-        建立数据库连接
-        :return:
+        预先建立连接，使空闲连接数达到n（不超过pool_size）
+        :return: 空闲连接数
         """
-        logging.info("open lazy connection ...")
-        self.connection = _LasyConnection()
-        self.transactions = 0
+        conns = [self.checkout() for i in range(min(n, self.pool_size))]
+        for conn in conns:
+            self.checkin(conn)
+        return len(self._idle)
 
-    def cleanup(self):
+    def dispose(self):
         """
-        关闭数据库连接
-        :return:
+        关闭所有空闲连接，已取出的连接在归还时照常处理
+        :return: None
         """
-        self.connection.cleanup()
-        self.connection = None
+        with self._lock:
+            idle = [conn for conn, born in self._idle]
+            self._idle.clear()
+        for conn in idle:
+            self._close(conn)
 
-    def cursor(self):
-        return self.connection.cursor()
+    def stats(self):
+        """
+        连接池统计信息
+        :return: Dict
+        """
+        with self._lock:
+            return Dict(pool_size=self.pool_size, max_overflow=self.max_overflow,
+                        in_use=self._in_use, idle=len(self._idle), created=self._created,
+                        checkouts=self._checkouts, waits=self._waits, timeouts=self._timeouts,
+                        wait_time=self._wait_time, max_wait=self._max_wait)
 
 
-_db_ctx = _DbCtx()
+def _close_cursor(cursor):
+    try:
+        cursor.close()
+    except Exception:
+        logger.warning('close cursor <%#x> failed.', id(cursor))
 
 
-# 用于with方法，建立数据库连接
-class _ConnectionCtx(object):
-    def __enter__(self):
-        global _db_ctx
-        self.should_cleanup = False
-        if not _db_ctx.is_init():
-            _db_ctx.init()
-            self.should_cleanup = True
-        return self
+# sql改写缓存：原始sql -> 把'?'替换为'%s'后的sql。与_fingerprints一样是普通dict，
+# 热路径上不加锁，超过上限时整体清空
+_statements = {}
+_statements_max = 256
+# [命中, 未命中, 淘汰]，多线程下的计数是近似值
+_statement_counts = [0, 0, 0]
 
-    def __exit__(self, exc_type, exc_value, exc_tb):
-        exception_logging(exc_type, exc_value, exc_tb, "_ConnectionCtx.__exit__")
-        global _db_ctx
-        if self.should_cleanup:
-            _db_ctx.cleanup()
 
+def _statement(sql):
+    """
+    改写sql占位符，结果按原始sql缓存，热点语句不必每次重新替换
+    :param sql: 使用'?'占位符的sql
+    :return: 使用'%s'占位符的sql
+    >>> _statement('select * from user where id = ?')
+    'select * from user where id = %s'
+    """
+    stmt = _statements.get(sql)
+    if stmt is None:
+        stmt = sql.replace('?', '%s')
+        _statement_counts[1] += 1
+        if len(_statements) >= _statements_max:
+            _statement_counts[2] += len(_statements)
+            _statements.clear()
+        if _statements_max > 0:
+            _statements[sql] = stmt
+    else:
+        _statement_counts[0] += 1
+    return stmt
 
-# 当外部调用多条语句，使用with connection()的用法时，只打开一条数据库连接，和__enter__中的if判断有关
-def connection():
-    return _ConnectionCtx()
 
+def _resize_statements(size):
+    global _statements_max
+    _statements_max = size
+    if len(_statements) > size:
+        _statement_counts[2] += len(_statements)
+        _statements.clear()
 
-def with_connection(func):
+
+# 语句指纹：去掉字面量后的规整sql，用于按语句汇总统计
+_FP_STRING_RE = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_FP_NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?(?:e[+-]?\d+)?\b', re.I)
+_FP_LIST_RE = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*')
+# 原始sql -> 指纹，热路径上只做一次dict查找；超过上限时整体清空
+_fingerprints = {}
+_FINGERPRINTS_MAX = 4096
+
+
+def fingerprint(sql):
     """
-    装饰器
-    :param func:
-    :return:
+    sql指纹：字面量和占位符替换为?，IN列表和多行VALUES合并为(?+)
+    >>> fingerprint("SELECT * FROM user WHERE id IN (1, 2, 3) AND name = 'Bob'")
+    'select * from user where id in (?+) and name = ?'
+    >>> fingerprint('insert into user (id,name) values (%s,%s),(%s,%s)')
+    'insert into user (id,name) values (?+)'
     """
-    @functools.wraps(func)
-    def wrapper(*args, **kw):
-        with connection():
-            return func(*args, **kw)
-    return wrapper
+    fp = _fingerprints.get(sql)
+    if fp is None:
+        fp = _FP_STRING_RE.sub('?', sql.replace('%s', '?'))
+        fp = _FP_NUMBER_RE.sub('?', fp)
+        fp = ' '.join(fp.split()).lower()
+        fp = _FP_LIST_RE.sub('(?+)', fp)
+        if len(_fingerprints) >= _FINGERPRINTS_MAX:
+            _fingerprints.clear()
+        _fingerprints[sql] = fp
+    return fp
 
 
-@with_connection
-def _select(sql, first, *args):
+# 延迟直方图的桶边界(秒)：100us起按1.25倍递增到约100s，百分位误差不超过25%
+_LATENCY_BOUNDS = [0.0001 * 1.25 ** i for i in range(63)]
+
+
+class _StatementStats(object):
     """
-    select实现函数
-    :param sql:
-    :param first:
-    :param args:
-    :return:
+    单个语句指纹的统计
+    >>> st = _StatementStats()
+    >>> for i in range(100):
+    ...     st.record(0.001 * (i + 1), 1, i == 0)
+    >>> st.count, st.errors, st.rows
+    (100, 1, 100)
+    >>> 0.05 <= st.percentile(0.5) <= 0.05 * 1.25
+    True
     """
-    global _db_ctx
-    cursor = None
-    names = []
-    sql = sql.replace('?', '%s')
-    logging.info("Sql: %s, Args: %s" % (sql, args))
-    try:
-        cursor = _db_ctx.cursor()
-        cursor.execute(sql, args)
-        if cursor.description:
-            names = [x[0] for x in cursor.description]
-        if first:
-            values = cursor.fetchone()
-            if not values:
-                return None
-            return Dict(names, values)
-        return [Dict(names, x) for x in cursor.fetchall()]
-    finally:
-        if cursor:
-            cursor.close()
-
+    __slots__ = ('count', 'errors', 'rows', 'total', 'max', 'buckets')
 
-# @with_connection
-def select_one(sql, *args):
-    return _select(sql, True, *args)
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(_LATENCY_BOUNDS) + 1)
 
+    def record(self, elapsed, rows, failed):
+        self.count += 1
+        self.rows += rows
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        if failed:
+            self.errors += 1
+        self.buckets[bisect.bisect_left(_LATENCY_BOUNDS, elapsed)] += 1
 
-# @with_connection
-def select_int(sql, *args):
-    d = _select(sql, True, *args)
-    # 若只返回一条记录，则为DICT，此时仍为一条记录
-    if len(d) != 1 and not isinstance(d, Dict):
-        raise MultiColumnsError('Expect only one column.')
-    return d.values()[0]
+    def percentile(self, p):
+        """
+        :return: 第p分位所在桶的上界，最后一个桶返回max
+        """
+        if not self.count:
+            return 0.0
+        target = p * self.count
+        n = 0
+        for i, c in enumerate(self.buckets):
+            n += c
+            if n >= target and c:
+                return min(_LATENCY_BOUNDS[i], self.max) if i < len(_LATENCY_BOUNDS) else self.max
+        return self.max
 
+    def snapshot(self):
+        return Dict(count=self.count, errors=self.errors, rows=self.rows, total_time=self.total,
+                    mean=self.total / self.count if self.count else 0.0, max=self.max,
+                    p50=self.percentile(0.5), p95=self.percentile(0.95), p99=self.percentile(0.99))
 
-# @with_connection
-def select(sql, *args):
-    return _select(sql, False, *args)
-
-#TODO:调整__init__和init
-#TODO:实现with用法
-#TODO:注意buffered导致第二个select能够成功，把连接托管给select, 尝试进程内自己管理
-class selector(object):
-    def __init__(self, n):
-        self.batch = n
-        self.cursor = None
-        self.data = None
-        self.names = []
 
-    def init(self,sql,*args):
+class _Metrics(object):
+    """
+    按语句指纹汇总的执行统计：次数、出错次数、返回/影响行数和延迟直方图
+    """
+    def __init__(self):
+        self.enabled = True
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, sql, elapsed, rows, failed):
+        fp = fingerprint(sql)
+        with self._lock:
+            st = self._stats.get(fp)
+            if st is None:
+                st = self._stats[fp] = _StatementStats()
+            st.record(elapsed, rows, failed)
+
+    def snapshot(self, reset=False):
+        with self._lock:
+            stats = self._stats
+            if reset:
+                self._stats = {}
+            return Dict(stats.keys(), [st.snapshot() for st in stats.values()])
+
+
+_metrics = _Metrics()
+
+
+def stats(reset=False):
+    """
+    按语句指纹统计的执行情况
+    :param reset: 取快照后是否清零
+    :return: Dict，指纹 -> Dict(count, errors, rows, total_time, mean, max, p50, p95, p99)
+    """
+    return _metrics.snapshot(reset)
+
+
+def enable_stats(enabled=True):
+    _metrics.enabled = enabled
+
+
+def _finish(sql, args, start, rows, failed):
+    """
+    语句执行后的统计和sql日志，两者都关闭时只有两次判断
+    """
+    if _metrics.enabled or _sql_log_mode is not None:
+        elapsed = time.time() - start
+        if _metrics.enabled:
+            _metrics.record(sql, elapsed, rows, failed)
+        if _sql_log_mode is not None:
+            _log_sql(sql, args, elapsed, rows, failed)
+
+
+# database engine object(数据库引擎对象)
+class _Engine(object):
+    def __init__(self, connect, prepared=False, prepared_cache_size=32, compact_rows=True, **pool_kw):
+        """
+        :param connect: mysql db connect
+        :param compact_rows: 查询结果使用Row(True)还是Dict(False)
+        :param prepared: 是否对每条连接缓存服务端预编译cursor
+        :param prepared_cache_size: 每条连接最多缓存的预编译cursor数
+        :param pool_kw: 连接池参数，见_ConnectionPool
+        :return: none
+        """
+        self._connect = connect
+        self._pool = _ConnectionPool(connect, **pool_kw)
+        self.compact_rows = compact_rows
+        self.prepared = prepared
+        self.prepared_cache_size = prepared_cache_size
+        self._prepared_hits = 0
+        self._prepared_misses = 0
+        self._prepared_evictions = 0
+        # LOAD DATA LOCAL INFILE是否可用，None表示还未尝试
+        self.local_infile = None
+
+    def connect(self):
+        """
+        :return: pointer of mysql connect
+        """
+        return self._pool.checkout()
+
+    def release(self, conn, discard=False):
+        """
+        把connect取出的连接归还给连接池
+        :return: None
+        """
+        self._pool.checkin(conn, discard)
+
+    def dispose(self):
+        self._pool.dispose()
+
+    def prewarm(self, n):
+        return self._pool.prewarm(n)
+
+    def reset_after_fork(self):
+        self._pool.reset_after_fork()
+
+    def pool_stats(self):
+        return self._pool.stats()
+
+    def _evict_prepared(self, sql, cursor):
+        self._prepared_evictions += 1
+        _close_cursor(cursor)
+
+    def prepared_cursor(self, conn, sql):
+        """
+        取得conn上sql对应的预编译cursor，同一连接上重复执行时服务端不再解析sql。
+        mysql.connector不支持缓冲的预编译cursor，连接默认buffered=True，这里显式关闭缓冲，
+        _execute_select会取完剩余的行。
+        :param conn: connect取出的连接
+        :param sql: 已改写占位符的sql
+        :return: cursor
+        >>> class FakeConn(object):
+        ...     def __init__(self):
+        ...         self.cursor_args = []
+        ...     def cursor(self, **kw):
+        ...         self.cursor_args.append(sorted(kw.items()))
+        ...         return object()
+        >>> eng = _Engine(FakeConn, prepared=True)
+        >>> conn = eng.connect()
+        >>> eng.prepared_cursor(conn, 'select 1') is eng.prepared_cursor(conn, 'select 1')
+        True
+        >>> conn.cursor_args
+        [[('buffered', False), ('prepared', True)]]
+        >>> eng.release(conn)
+        """
+        record = self._pool.record(conn)
+        if record.cursors is None:
+            record.cursors = _LRUCache(self.prepared_cache_size, on_evict=self._evict_prepared)
+        cursor = record.cursors.get(sql)
+        if cursor is None:
+            self._prepared_misses += 1
+            cursor = conn.cursor(prepared=True, buffered=False)
+            record.cursors.put(sql, cursor)
+        else:
+            self._prepared_hits += 1
+        return cursor
+
+    def discard_prepared(self, conn, sql):
+        """
+        执行出错后丢弃预编译cursor，下次重新prepare
+        :return: None
+        """
+        record = self._pool.record(conn)
+        cursor = record.cursors.pop(sql) if record.cursors is not None else None
+        if cursor is not None:
+            _close_cursor(cursor)
+
+    def prepared_stats(self):
+        return Dict(enabled=self.prepared, capacity=self.prepared_cache_size, hits=self._prepared_hits,
+                    misses=self._prepared_misses, evictions=self._prepared_evictions)
+
+# global engine object:
+engine = None
+
+
+def create_engine(user, password, database, host='127.0.0.1', port=3306,
+                  pool_size=5, max_overflow=10, pool_timeout=30, recycle=3600,
+                  statement_cache_size=256, prepared=False, prepared_cache_size=32, compact_rows=True, **kw):
+    """
+    创建engine连接
+    :param user: database username
+    :param password: database password
+    :param database: database name
+    :param host: host
+    :param port: port
+    :param pool_size: 连接池保留的空闲连接数，0表示每次用完即关闭
+    :param max_overflow: 超出pool_size后允许临时建立的连接数
+    :param pool_timeout: 等待可用连接的最长秒数
+    :param recycle: 连接最长存活秒数，应小于MySQL的wait_timeout
+    :param statement_cache_size: sql改写缓存的条数
+    :param prepared: 是否使用服务端预编译语句(cursor(prepared=True))
+    :param prepared_cache_size: 每条连接缓存的预编译语句数
+    :param compact_rows: 查询结果使用共享列结构的Row，需要dict子类(如json序列化)时设为False
+    :param kw: 其他参数
+    :return: None
+    """
+    global engine
+    if engine is not None:
+        raise DBError("Engine is already initialized.")
+    engine = _Engine(_mysql_connect(user, password, database, host, port, kw), compact_rows=compact_rows,
+                     prepared=prepared, prepared_cache_size=prepared_cache_size, pool_size=pool_size,
+                     max_overflow=max_overflow, pool_timeout=pool_timeout, recycle=recycle)
+    _resize_statements(statement_cache_size)
+    # test connection...
+    logger.info('Init mysql engine <%#x> ok.', id(engine))
+
+
+def _mysql_connect(user, password, database, host, port, kw):
+    """
+    :return: 建立mysql连接的回调函数
+    """
+    if mysql is None:
+        raise DBError("mysql.connector is not installed.")
+    params = dict(user=user, password=password, database=database, host=host, port=port)
+    defaults = dict(use_unicode=True, charset='utf8', collation='utf8_general_ci', autocommit=False)
+    for k, v in defaults.iteritems():
+        params[k] = kw.pop(k, v)
+    params.update(kw)
+    # buffered参数：cursor是否立即返回fetch结果（缓存区）
+    params['buffered'] = True
+    # 使用lambda可以使mysql.connector.connect(**params)整体变为一个回调函数，只有在实际调用时才会运行函数。
+    return lambda: mysql.connector.connect(**params)
+
+
+class _SqliteCursor(object):
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, sql, args=()):
+        if sql.lstrip()[:9].lower() == 'load data':
+            # 与不支持LOAD DATA的驱动一样报告DB-API的NotSupportedError
+            import sqlite3
+            raise sqlite3.NotSupportedError('LOAD DATA is not supported by sqlite.')
+        self._cursor.execute(sql.replace('%s', '?'), tuple(args))
+
+    def executemany(self, sql, seq_of_args):
+        self._cursor.executemany(sql.replace('%s', '?'), [tuple(a) for a in seq_of_args])
+
+    def __getattr__(self, key):
+        return getattr(self._cursor, key)
+
+
+class _SqliteConnection(object):
+    def __init__(self, path):
+        import sqlite3
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+
+    def cursor(self, **kw):
+        return _SqliteCursor(self._conn.cursor())
+
+    def __getattr__(self, key):
+        return getattr(self._conn, key)
+
+
+def _sqlite_connect(path):
+    """
+    本地测试用的sqlite3替身：把'%s'占位符改回sqlite的'?'，语句须是sqlite支持的语法
+    :param path: 数据库文件路径，多条连接共享同一个文件
+    :return: 建立连接的回调函数，用于_Engine(...)
+    """
+    return lambda: _SqliteConnection(path)
+
+
+# 读写分离：只读的replica engine
+class _ReplicaDown(DBError):
+    pass
+
+
+class _Replica(object):
+    def __init__(self, name, eng):
+        self.name = name
+        self.engine = eng
+        self.outstanding = 0
+        self.reads = 0
+        self.errors = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+
+
+def _is_connection_error(e):
+    """
+    连接类错误（断线、超时、拒绝连接）才会使replica被摘除，sql本身的错误照常抛出
+    """
+    return isinstance(e, PoolTimeoutError) or \
+        e.__class__.__name__ in ('OperationalError', 'InterfaceError') or \
+        isinstance(e, (IOError, OSError))
+
+
+class _ReplicaSet(object):
+    """
+    replica集合：按round_robin或least_outstanding选择replica，连续失败max_failures次后摘除eject_seconds秒
+    """
+    def __init__(self):
+        self._replicas = []
+        self._lock = threading.Lock()
+        self._next = 0
+        self.policy = 'round_robin'
+        self.sticky_seconds = 1.0
+        self.max_failures = 1
+        self.eject_seconds = 30.0
+
+    def __len__(self):
+        return len(self._replicas)
+
+    def add(self, eng, name=None):
+        with self._lock:
+            name = name or 'replica-%d' % len(self._replicas)
+            if any(r.name == name for r in self._replicas):
+                raise DBError("Replica %s is already registered." % name)
+            self._replicas.append(_Replica(name, eng))
+
+    def remove(self, name):
+        with self._lock:
+            replicas = [r for r in self._replicas if r.name == name]
+            self._replicas = [r for r in self._replicas if r.name != name]
+        for r in replicas:
+            r.engine.dispose()
+
+    def pick(self):
+        now = time.time()
+        with self._lock:
+            live = [r for r in self._replicas if r.ejected_until <= now]
+            if not live:
+                return None
+            if self.policy == 'least_outstanding':
+                r = min(live, key=lambda x: x.outstanding)
+            else:
+                self._next += 1
+                r = live[self._next % len(live)]
+            r.outstanding += 1
+            return r
+
+    def run(self, replica, func, *args):
+        """
+        在pick选出的replica上执行func，连接类错误时记录失败并抛出_ReplicaDown，由调用方改用主库
+        """
+        try:
+            r = func(*args)
+            with self._lock:
+                replica.reads += 1
+                replica.failures = 0
+            return r
+        except Exception as e:
+            if not _is_connection_error(e):
+                raise
+            self.failed(replica, e)
+            raise _ReplicaDown(str(e))
+        finally:
+            with self._lock:
+                replica.outstanding -= 1
+
+    def failed(self, replica, e):
+        with self._lock:
+            replica.errors += 1
+            replica.failures += 1
+            if replica.failures >= self.max_failures:
+                replica.ejected_until = time.time() + self.eject_seconds
+                logger.warning('[REPLICA] eject %s for %ss: %s', replica.name, self.eject_seconds, e)
+
+    def check(self):
+        """
+        对每个replica执行select 1，成功的恢复，失败的摘除
+        :return: {name: 是否健康}
+        """
+        result = {}
+        for replica in list(self._replicas):
+            try:
+                conn = _LasyConnection(replica.engine)
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute('select 1')
+                    cursor.fetchall()
+                    cursor.close()
+                finally:
+                    conn.cleanup()
+            except Exception as e:
+                with self._lock:
+                    replica.failures = max(replica.failures, self.max_failures - 1)
+                self.failed(replica, e)
+                result[replica.name] = False
+            else:
+                with self._lock:
+                    replica.failures = 0
+                    replica.ejected_until = 0.0
+                result[replica.name] = True
+        return result
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            return [Dict(name=r.name, healthy=r.ejected_until <= now, outstanding=r.outstanding, reads=r.reads,
+                         errors=r.errors, pool=r.engine.pool_stats()) for r in self._replicas]
+
+
+_replicas = _ReplicaSet()
+
+
+def add_replica(user, password=None, database=None, host='127.0.0.1', port=3306, name=None,
+                pool_size=5, max_overflow=10, pool_timeout=30, recycle=3600, prepared=False, **kw):
+    """
+    注册只读replica。不在事务中、且距本线程上次写操作超过sticky_seconds的select、select_one、
+    select_int、select_columns和stream会分摊到replica上，其他语句仍走create_engine创建的主库。
+    开启结果缓存时，缓存未命中的查询在主库上执行
+    :param user: mysql用户名；也可以是_Engine，或建立连接的回调函数（如_sqlite_connect(path)）
+    :param name: replica名称，默认为replica-N
+    :param kw: 其他参数同create_engine
+    :return: None
+
+    >>> module = sys.modules[__name__]
+    >>> paths = [tempfile.mktemp(), tempfile.mktemp()]
+    >>> for path, value in zip(paths, ('primary', 'replica')):
+    ...     with _EngineCtx(_Engine(_sqlite_connect(path))):
+    ...         n = update('create table t (name text)')
+    ...         n = update('insert into t values (?)', value)
+    >>> saved, module.engine = module.engine, _Engine(_sqlite_connect(paths[0]))
+    >>> def down():
+    ...     raise IOError('connection refused')
+    >>> add_replica(_sqlite_connect(paths[1]), name='r1')
+    >>> add_replica(down, name='r2')
+    >>> configure_replicas(max_failures=1, eject_seconds=60)
+    >>> _db_ctx.last_write = 0.0
+
+    r2连接失败时本次读改用主库，r2被摘除，之后的读都走r1：
+    >>> [select_one('select name from t').name for i in range(3)]
+    [u'primary', u'replica', u'replica']
+    >>> [(st.name, st.healthy, st.reads, st.errors) for st in replica_stats()]
+    [('r1', True, 2, 0), ('r2', False, 0, 1)]
+
+    写操作后sticky_seconds内本线程的读仍走主库，事务中的读总是走主库：
+    >>> n = update('update t set name=?', 'written')
+    >>> select_one('select name from t').name
+    u'written'
+    >>> _db_ctx.last_write = 0.0
+    >>> select_one('select name from t').name
+    u'replica'
+    >>> with transaction():
+    ...     select_one('select name from t').name
+    u'written'
+    >>> check_replicas() == {'r1': True, 'r2': False}
+    True
+    >>> remove_replica('r1'), remove_replica('r2'), configure_replicas()
+    (None, None, None)
+    >>> module.engine = saved
+    >>> for path in paths:
+    ...     os.remove(path)
+    """
+    if isinstance(user, _Engine):
+        _replicas.add(user, name)
+        return
+    if callable(user):
+        eng = _Engine(user, prepared=prepared, pool_size=pool_size, max_overflow=max_overflow,
+                      pool_timeout=pool_timeout, recycle=recycle)
+        _replicas.add(eng, name)
+        return
+    eng = _Engine(_mysql_connect(user, password, database, host, port, kw), prepared=prepared,
+                  pool_size=pool_size, max_overflow=max_overflow, pool_timeout=pool_timeout, recycle=recycle)
+    _replicas.add(eng, name)
+    logger.info('Add mysql replica <%s> %s:%s ok.', name, host, port)
+
+
+def remove_replica(name):
+    _replicas.remove(name)
+
+
+def configure_replicas(policy='round_robin', sticky_seconds=1.0, max_failures=1, eject_seconds=30.0):
+    """
+    :param policy: 'round_robin' 或 'least_outstanding'
+    :param sticky_seconds: 写操作后多少秒内本线程的读仍走主库
+    :param max_failures: 连续几次连接失败后摘除replica
+    :param eject_seconds: 摘除多少秒后再次尝试
+    :return: None
+    """
+    if policy not in ('round_robin', 'least_outstanding'):
+        raise ValueError('Invalid replica policy: %r' % policy)
+    _replicas.policy = policy
+    _replicas.sticky_seconds = sticky_seconds
+    _replicas.max_failures = max_failures
+    _replicas.eject_seconds = eject_seconds
+
+
+def check_replicas():
+    """
+    主动健康检查，可由定时任务调用
+    :return: {name: 是否健康}
+    """
+    return _replicas.check()
+
+
+def replica_stats():
+    return _replicas.stats()
+
+
+def _pick_replica():
+    """
+    :return: 本次读操作使用的replica，应使用主库时返回None
+    """
+    global _db_ctx
+    if not _replicas or _db_ctx.transactions > 0 or _db_ctx.engine is not None:
+        return None
+    if time.time() - _db_ctx.last_write < _replicas.sticky_seconds:
+        return None
+    return _replicas.pick()
+
+
+def _read_on(eng, func, args):
+    conn = _LasyConnection(eng)
+    try:
+        return func(conn, *args)
+    finally:
+        conn.cleanup()
+
+
+def _read(func, *args):
+    """
+    读操作：按读写分离规则在replica或主库上执行func(conn, *args)，replica连接失败时改用主库
+    """
+    global _db_ctx
+    replica = _pick_replica()
+    if replica is not None:
+        try:
+            return _replicas.run(replica, _read_on, replica.engine, func, args)
+        except _ReplicaDown:
+            pass
+    with connection():
+        return func(_db_ctx.connection, *args)
+
+
+# 分片：把当前线程的数据库上下文临时切换到指定engine
+class _EngineCtx(object):
+    """
+    with _EngineCtx(eng): 其中的db操作（含connection()、transaction()）都使用eng的连接，
+    退出时恢复原来的连接和事务状态。外层事务不会包含切换后执行的语句。
+    """
+    def __init__(self, eng):
+        self.engine = eng
+        self._saved = []
+
+    def __enter__(self):
+        global _db_ctx
+        if _db_ctx.engine is self.engine:
+            self._saved.append(None)
+            return self
+        self._saved.append(_db_ctx.save())
+        _db_ctx.load(_DbCtx.initial(self.engine, _db_ctx.last_write))
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        global _db_ctx
+        saved = self._saved.pop()
+        if saved is None:
+            return
+        try:
+            if _db_ctx.is_init():
+                _db_ctx.cleanup()
+        finally:
+            last_write = _db_ctx.last_write
+            _db_ctx.load(saved)
+            _db_ctx.last_write = max(last_write, _db_ctx.last_write)
+
+
+class _ShardCtx(_EngineCtx):
+    """
+    shard()返回的对象，可用于with，也可以直接调用select/update/insert/transaction
+    """
+    def __init__(self, name, eng):
+        super(_ShardCtx, self).__init__(eng)
+        self.name = name
+
+    def _call(self, func, *args, **kw):
+        with self:
+            return func(*args, **kw)
+
+    def select(self, sql, *args, **kw):
+        return self._call(select, sql, *args, **kw)
+
+    def select_one(self, sql, *args, **kw):
+        return self._call(select_one, sql, *args, **kw)
+
+    def select_int(self, sql, *args, **kw):
+        return self._call(select_int, sql, *args, **kw)
+
+    def update(self, sql, *args):
+        return self._call(update, sql, *args)
+
+    def insert(self, table, **kw):
+        return self._call(insert, table, **kw)
+
+    def insert_many(self, table, rows, **kw):
+        return self._call(insert_many, table, rows, **kw)
+
+    def transaction(self):
+        return _ShardTransactionCtx(self)
+
+
+class _ShardTransactionCtx(object):
+    def __init__(self, shard_ctx):
+        self.shard_ctx = shard_ctx
+        self.tx = _TransactionCtx()
+
+    def __enter__(self):
+        self.shard_ctx.__enter__()
+        try:
+            self.tx.__enter__()
+        except:
+            self.shard_ctx.__exit__(*sys.exc_info())
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        try:
+            self.tx.__exit__(exc_type, exc_value, exc_tb)
+        finally:
+            self.shard_ctx.__exit__(exc_type, exc_value, exc_tb)
+
+
+def hash_sharding(key, names):
+    """
+    默认分片函数：crc32(key) % 分片数
+    >>> hash_sharding(42, ['s0', 's1', 's2'])
+    's2'
+    """
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return names[(zlib.crc32(str(key)) & 0xffffffff) % len(names)]
+
+
+def range_sharding(bounds):
+    """
+    按范围分片
+    >>> f = range_sharding([(1000, 's0'), (2000, 's1'), (None, 's2')])
+    >>> f(5, None), f(1000, None), f(10 ** 9, None)
+    ('s0', 's1', 's2')
+
+    :param bounds: [(上界(不含), 分片名), ...]，按上界升序，最后一个上界可为None表示无穷大
+    :return: 分片函数
+    """
+    uppers = [b for b, name in bounds if b is not None]
+    names = [name for b, name in bounds]
+
+    def shard_of(key, all_names):
+        i = bisect.bisect_right(uppers, key)
+        if i >= len(names):
+            raise DBError('Shard key %r is out of range.' % (key,))
+        return names[i]
+    return shard_of
+
+
+class _ShardSet(object):
+    def __init__(self):
+        self._engines = collections.OrderedDict()
+        self.shard_function = hash_sharding
+
+    def add(self, name, eng):
+        if name in self._engines:
+            raise DBError("Shard %s is already registered." % name)
+        self._engines[name] = eng
+
+    def remove(self, name):
+        eng = self._engines.pop(name, None)
+        if eng is not None:
+            eng.dispose()
+
+    def names(self):
+        return self._engines.keys()
+
+    def get(self, name):
+        eng = self._engines.get(name)
+        if eng is None:
+            raise DBError("Shard %s is not registered." % name)
+        return _ShardCtx(name, eng)
+
+    def route(self, key):
+        if not self._engines:
+            raise DBError("No shard is registered.")
+        return self.get(self.shard_function(key, self.names()))
+
+
+_shards = _ShardSet()
+
+
+def add_shard(name, user, password=None, database=None, host='127.0.0.1', port=3306,
+              pool_size=5, max_overflow=10, pool_timeout=30, recycle=3600, prepared=False, **kw):
+    """
+    注册分片，分片按注册顺序参与hash_sharding
+    :param name: 分片名
+    :param user: mysql用户名；也可以是_Engine，或建立连接的回调函数（如_sqlite_connect(path)）
+    :param kw: 其他参数同create_engine
+    :return: None
+
+    >>> paths = [tempfile.mktemp() for i in range(2)]
+    >>> for i, path in enumerate(paths):
+    ...     add_shard('test%d' % i, _sqlite_connect(path))
+    ...     n = shard(name='test%d' % i).update('create table t (id int primary key, v int)')
+    >>> for i in range(1, 9):
+    ...     n = shard(i).insert('t', id=i, v=i * 10)
+    >>> [shard(name=name).select_int('select count(*) from t') for name in ('test0', 'test1')]
+    [4, 4]
+    >>> all(shard(i).select_int('select v from t where id=?', i) == i * 10 for i in range(1, 9))
+    True
+    >>> try:
+    ...     with shard(1).transaction():
+    ...         n = update('update t set v=0 where id=1')
+    ...         raise ValueError
+    ... except ValueError:
+    ...     pass
+    >>> with shard(2).transaction():
+    ...     n = update('update t set v=0 where id=2')
+    >>> shard(1).select_int('select v from t where id=1'), shard(2).select_int('select v from t where id=2')
+    (10, 0)
+    >>> sql = 'select * from t order by v desc limit 3'
+    >>> [r.id for r in select_shards(sql, order_by='v', reverse=True, limit=3, shards=['test0', 'test1'])]
+    [8, 7, 6]
+    >>> for i, path in enumerate(paths):
+    ...     remove_shard('test%d' % i)
+    ...     os.remove(path)
+    """
+    if isinstance(user, _Engine):
+        _shards.add(name, user)
+        return
+    if callable(user):
+        eng = _Engine(user, prepared=prepared, pool_size=pool_size, max_overflow=max_overflow,
+                      pool_timeout=pool_timeout, recycle=recycle)
+        _shards.add(name, eng)
+        return
+    eng = _Engine(_mysql_connect(user, password, database, host, port, kw), prepared=prepared,
+                  pool_size=pool_size, max_overflow=max_overflow, pool_timeout=pool_timeout, recycle=recycle)
+    _shards.add(name, eng)
+    logger.info('Add mysql shard <%s> %s:%s ok.', name, host, port)
+
+
+def remove_shard(name):
+    """
+    注销分片并关闭它的空闲连接
+    """
+    _shards.remove(name)
+
+
+def set_shard_function(func):
+    """
+    :param func: func(key, 分片名列表) -> 分片名，可使用hash_sharding或range_sharding(bounds)
+    :return: None
+    """
+    _shards.shard_function = func
+
+
+def shard(key=None, name=None):
+    """
+    按分片键（或直接按分片名）选择分片。
+    with db.shard(user_id):
+        db.select_one('select * from user where id=?', user_id)
+    with db.shard(user_id).transaction():
+        db.update(...)
+    :return: _ShardCtx
+    """
+    if name is not None:
+        return _shards.get(name)
+    return _shards.route(key)
+
+
+def select_shards(sql, *args, **kw):
+    """
+    在所有（或指定的）分片上并发执行select，合并结果
+    :param order_by: 合并后排序的列名或key函数
+    :param reverse: 是否倒序
+    :param limit: 合并排序后最多返回的行数；各分片的sql中也应带上相同的order by和limit
+    :param shards: 分片名列表，默认全部分片
+    :return: list
+    """
+    order_by = kw.pop('order_by', None)
+    reverse = kw.pop('reverse', False)
+    limit = kw.pop('limit', None)
+    names = kw.pop('shards', None) or _shards.names()
+    if kw:
+        raise TypeError('unexpected keyword arguments: %s' % ', '.join(kw.keys()))
+    ctxs = [_shards.get(name) for name in names]
+    results = [None] * len(ctxs)
+    errors = [None] * len(ctxs)
+
+    def work(i):
+        try:
+            results[i] = ctxs[i].select(sql, *args)
+        except Exception:
+            errors[i] = sys.exc_info()
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(1, len(ctxs))]
+    for t in threads:
+        t.start()
+    if ctxs:
+        work(0)
+    for t in threads:
+        t.join()
+    for name, error in zip(names, errors):
+        if error is not None:
+            logger.error('select on shard %s failed.', name)
+            raise error[0], error[1], error[2]
+    rows = list(itertools.chain.from_iterable(results))
+    if order_by is not None:
+        rows.sort(key=order_by if callable(order_by) else lambda r: r[order_by], reverse=reverse)
+    if limit is not None:
+        rows = rows[:limit]
+    return rows
+
+
+def pool_stats():
+    """
+    当前engine的连接池统计：in_use, idle, waits, wait_time等
+    :return: Dict
+    """
+    if engine is None:
+        raise DBError("Engine is not initialized.")
+    return engine.pool_stats()
+
+
+def statement_cache_stats():
+    """
+    sql改写缓存和预编译cursor缓存的命中、未命中、淘汰计数
+    :return: Dict
+    """
+    hits, misses, evictions = _statement_counts
+    sql = Dict(hits=hits, misses=misses, evictions=evictions, size=len(_statements), capacity=_statements_max)
+    return Dict(sql=sql, prepared=engine.prepared_stats() if engine else None)
+
+
+# 数据库底层连接封装
+class _LasyConnection(object):
+    """
+    惰性连接封装，仅当需要调用cursor时才连接数据库
+    """
+    def __init__(self, eng=None):
+        """
+        :param eng: 从哪个engine取连接，默认为全局engine
+        """
+        self.connection = None
+        self.engine = eng if eng is not None else engine
+
+    def _connect(self):
+        if self.connection is None:
+            conn = self.engine.connect()
+            logger.debug('[CONNECTION] [CHECKOUT] connection <%#x>...', id(conn))
+            self.connection = conn
+        return self.connection
+
+    def cursor(self, **kw):
+        """
+        只有当需要调用cursor时才会连接数据库
+        :param kw: 传给驱动cursor()的参数，如buffered=False
+        :return: None
+        """
+        return self._connect().cursor(**kw)
+
+    def statement_cursor(self, sql):
+        """
+        执行sql用的cursor，engine开启prepared时返回连接上缓存的预编译cursor
+        :param sql: 已改写占位符的sql
+        :return: (cursor, 用完后是否需要close)
+        """
+        conn = self._connect()
+        if self.engine.prepared:
+            return self.engine.prepared_cursor(conn, sql), False
+        return conn.cursor(), True
+
+    def discard_cursor(self, sql):
+        if self.connection is not None and self.engine.prepared:
+            self.engine.discard_prepared(self.connection, sql)
+
+    def commit(self):
+        # 事务中没有执行过语句时还没有建立连接，无需提交
+        if self.connection is not None:
+            return self.connection.commit()
+
+    def rollback(self):
+        if self.connection is not None:
+            return self.connection.rollback()
+
+    def cleanup(self):
+        """
+        把数据库连接归还给连接池
+        :return: None
+        """
+        if self.connection:
+            conn = self.connection
+            self.connection = None
+            logger.debug('[CONNECTION] [CHECKIN] connection <%#x>...', id(conn))
+            self.engine.release(conn)
+
+
+# 持有数据库连接的上下文对象:
+# threading.local的继承，会对每一个线程生成新的局部变量，即使_db_ctx是全局的
+# （gevent的monkey patch会把threading.local换成每个greenlet一份；同一线程中交替执行的任务用_TaskCtx）
+class _DbCtx(threading.local):
+    # 随上下文切换保存和恢复的属性
+    _fields = ('connection', 'transactions', 'invalidations', 'last_write', 'engine', 'tx_state', 'before_commit')
+
+    def __init__(self):
+        super(_DbCtx, self).__init__()
+        self.connection = None
+        self.transactions = 0
+        # 事务中写过的表，提交后才使结果缓存失效
+        self.invalidations = set()
+        # 最近一次写操作的时间，之后一段时间内的读走主库
+        self.last_write = 0.0
+        # 不为None时本线程的连接从该engine取得（分片），否则使用全局engine
+        self.engine = None
+        # 最外层事务内有效的上层状态（如orm的identity map），事务结束时清空
+        self.tx_state = {}
+        # 最外层事务提交前执行的回调
+        self.before_commit = []
+
+    def save(self):
+        """
+        :return: 当前的连接和事务状态
+        """
+        return tuple([getattr(self, f) for f in self._fields])
+
+    def load(self, state):
+        for f, v in zip(self._fields, state):
+            setattr(self, f, v)
+
+    @staticmethod
+    def initial(eng=None, last_write=0.0):
+        """
+        :return: 没有连接和事务的初始状态
+        """
+        return None, 0, set(), last_write, eng, {}, []
+
+    def is_init(self):
+        """
+        判断数据库是否初始化（建立连接）
+        :return:
+        """
+        return self.connection is not None
+
+    def init(self):
+        """
+        建立数据库连接
+        :return:
+        """
+        logger.debug("open lazy connection ...")
+        self.connection = _LasyConnection(self.engine)
+        self.transactions = 0
+        self.invalidations = set()
+        self.tx_state = {}
+        self.before_commit = []
+
+    def cleanup(self):
+        """
+        关闭数据库连接
+        :return:
+        """
+        self.connection.cleanup()
+        self.connection = None
+
+    def cursor(self, **kw):
+        return self.connection.cursor(**kw)
+
+    def statement_cursor(self, sql):
+        return self.connection.statement_cursor(sql)
+
+
+_db_ctx = _DbCtx()
+
+
+class _TaskCtx(object):
+    """
+    独立的数据库上下文，供在同一线程上交替执行的任务（生成器协程、回调）使用：
+    每个任务一个上下文，每次恢复执行都放在run()中，任务之间的连接、事务嵌套互不影响。
+    >>> def task(name, log):
+    ...     with transaction():
+    ...         log.append((name, _db_ctx.transactions))
+    ...         yield
+    ...         with transaction():
+    ...             log.append((name, _db_ctx.transactions))
+    ...             yield
+    >>> log = []
+    >>> tasks = [(new_context(), task('a', log)), (new_context(), task('b', log))]
+    >>> for i in range(3):
+    ...     for ctx, t in tasks:
+    ...         ctx.run(next, t, None)
+    >>> log
+    [('a', 1), ('b', 1), ('a', 2), ('b', 2)]
+    >>> _db_ctx.transactions, _db_ctx.is_init()
+    (0, False)
+    """
+    def __init__(self):
+        self._state = _DbCtx.initial()
+
+    def run(self, func, *args, **kw):
+        """
+        在本上下文中执行func，返回其结果
+        """
+        global _db_ctx
+        saved = _db_ctx.save()
+        _db_ctx.load(self._state)
+        try:
+            return func(*args, **kw)
+        finally:
+            self._state = _db_ctx.save()
+            _db_ctx.load(saved)
+
+    def close(self):
+        """
+        释放本上下文持有的连接（任务中途放弃时，任务的生成器应先在run()中close()）
+        """
+        if self._state[0] is not None:
+            self.run(_db_ctx.cleanup)
+
+
+def new_context():
+    """
+    :return: 新的独立数据库上下文，见_TaskCtx
+    """
+    return _TaskCtx()
+
+
+# 用于with方法，建立数据库连接
+class _ConnectionCtx(object):
+    def __enter__(self):
+        global _db_ctx
+        self.should_cleanup = False
+        if not _db_ctx.is_init():
+            _db_ctx.init()
+            self.should_cleanup = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        exception_logging(exc_type, exc_value, exc_tb, "_ConnectionCtx.__exit__")
+        global _db_ctx
+        if self.should_cleanup:
+            _db_ctx.cleanup()
+
+
+# 当外部调用多条语句，使用with connection()的用法时，只打开一条数据库连接，和__enter__中的if判断有关
+def connection():
+    return _ConnectionCtx()
+
+
+def with_connection(func):
+    """
+    装饰器
+    :param func:
+    :return:
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kw):
+        with connection():
+            return func(*args, **kw)
+    return wrapper
+
+
+def _execute_select(conn, sql, first, args):
+    """
+    select实现函数
+    :param conn: 执行语句的_LasyConnection
+    :param sql:
+    :param first:
+    :param args:
+    :return: (列名, 驱动返回的values)
+    """
+    cursor = None
+    should_close = True
+    names = []
+    sql = _statement(sql)
+    start = time.time()
+    rows, failed = 0, True
+    try:
+        cursor, should_close = conn.statement_cursor(sql)
+        cursor.execute(sql, args)
+        if cursor.description:
+            names = [x[0] for x in cursor.description]
+        if first:
+            values = cursor.fetchone()
+            if not should_close:
+                # 预编译cursor会被复用，需读完剩余结果
+                cursor.fetchall()
+            rows = 1 if values else 0
+        else:
+            values = cursor.fetchall()
+            rows = len(values)
+        failed = False
+        return names, values
+    except:
+        if cursor and not should_close:
+            conn.discard_cursor(sql)
+        raise
+    finally:
+        if cursor and should_close:
+            cursor.close()
+        _finish(sql, args, start, rows, failed)
+
+
+@with_connection
+def _select_values(sql, first, *args):
+    """
+    在主库（当前线程的连接）上执行select
+    """
+    global _db_ctx
+    return _execute_select(_db_ctx.connection, sql, first, args)
+
+
+def _read_values(sql, first, args):
+    """
+    按读写分离规则在replica或主库上执行select
+    """
+    return _read(_execute_select, sql, first, args)
+
+
+def _make_result(names, values, first):
+    if first:
+        if not values:
+            return None
+        return _row_maker(names)(values)
+    make = _row_maker(names)
+    return [make(x) for x in values]
+
+
+def _select(sql, first, *args):
+    names, values = _read_values(sql, first, args)
+    return _make_result(names, values, first)
+
+
+_SELECT_TABLES_RE = re.compile(r'\b(?:from|join)\s+([`\w.]+(?:\s*(?:as\s+)?\w*\s*,\s*[`\w.]+)*)', re.I)
+_WRITE_TABLE_RE = re.compile(r'^\s*(?:(?:insert|replace)(?:\s+(?:low_priority|delayed|high_priority|ignore))*\s+(?:into\s+)?'
+                             r'|update(?:\s+(?:low_priority|ignore))*\s+'
+                             r'|delete(?:\s+(?:low_priority|quick|ignore))*\s+from\s+)([`\w.]+)\s*(?:\(|set\b|values\b|where\b|select\b|$)',
+                             re.I)
+
+
+def _table_name(name):
+    return name.strip('`').split('.')[-1].strip('`').lower()
+
+
+def _select_tables(sql):
+    """
+    :return: select语句引用的表名集合
+    >>> sorted(_select_tables('select * from blogs b, `users` where b.uid in (select id from t.follows)'))
+    ['blogs', 'follows', 'users']
+    """
+    tables = set()
+    for m in _SELECT_TABLES_RE.finditer(sql):
+        for part in m.group(1).split(','):
+            tables.add(_table_name(part.split()[0]))
+    return tables
+
+
+def _write_tables(sql):
+    """
+    :return: 写语句修改的表名集合，无法识别时返回set(['*'])，表示全部失效
+    >>> _write_tables('insert into user (id, name) values (%s, %s)')
+    set(['user'])
+    >>> _write_tables('update `test`.`user` set name=%s where id=%s')
+    set(['user'])
+    >>> _write_tables('drop table user')
+    set(['*'])
+    """
+    m = _WRITE_TABLE_RE.match(sql)
+    if m is None:
+        return set(['*'])
+    return set([_table_name(m.group(1))])
+
+
+# 查询结果缓存
+class _ResultCache(object):
+    """
+    进程内的select结果缓存，按规整后的sql和参数作为key，支持TTL、LRU淘汰和按表失效。
+    缓存的是驱动返回的values，每次命中重新构造结果行，调用方修改结果不会影响缓存。
+    """
+    def __init__(self, max_entries=10000, max_rows=1000000, ttl=None):
+        """
+        :param max_entries: 最多缓存的结果数
+        :param max_rows: 所有结果的总行数上限
+        :param ttl: 默认TTL秒数，None表示只缓存指定了cache_ttl或匹配cache_pattern的语句
+        """
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self._patterns = []
+        self._data = collections.OrderedDict()
+        self._tables = collections.defaultdict(set)
+        # 每张表的写入代数，查询期间表被修改时不写入缓存
+        self._generations = collections.defaultdict(int)
+        self._rows = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def add_pattern(self, pattern, ttl):
+        self._patterns.append((re.compile(pattern, re.I), ttl))
+
+    def ttl_for(self, sql, ttl):
+        if ttl is not None:
+            return ttl
+        for pattern, pattern_ttl in self._patterns:
+            if pattern.search(sql):
+                return pattern_ttl
+        return self.ttl
+
+    def select(self, sql, first, args, ttl=None):
         global _db_ctx
-        self.should_cleanup = False
-        if not _db_ctx.is_init():
-            _db_ctx.init()
-            self.should_cleanup = True
-        sql = sql.replace('?', '%s')
-        logging.info("Sql: %s, Args: %s" % (sql, args))
+        ttl = self.ttl_for(sql, ttl)
+        # 事务中写过数据后，读到的可能是未提交的数据，不使用缓存；分片上的查询也不缓存
+        if not ttl or _db_ctx.invalidations or _db_ctx.engine is not None:
+            return _select(sql, first, *args)
+        key = (' '.join(sql.split()), first, args)
+        try:
+            hash(key)
+        except TypeError:
+            return _select(sql, first, *args)
+        tables = _select_tables(sql)
+        now = time.time()
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None and entry[0] > now:
+                self._data[key] = entry
+                self.hits += 1
+                return _make_result(entry[2], entry[3], first)
+            if entry is not None:
+                self._drop(key, entry)
+            self.misses += 1
+            generations = [(t, self._generations[t]) for t in tables]
+            star = self._generations['*']
+        # 只用主库的结果填充缓存：replica可能落后，其他线程写入并失效缓存后，
+        # 从replica读到的旧数据会被缓存整个TTL
+        names, values = _select_values(sql, first, *args)
+        rows = 1 if first else len(values)
+        if rows <= self.max_rows:
+            with self._lock:
+                if star == self._generations['*'] and \
+                        all(self._generations[t] == g for t, g in generations):
+                    self._put(key, (now + ttl, tables, names, values, rows))
+        return _make_result(names, values, first)
+
+    def _put(self, key, entry):
+        # 调用方须持有self._lock
+        old = self._data.pop(key, None)
+        if old is not None:
+            self._drop(key, old)
+        self._data[key] = entry
+        self._rows += entry[4]
+        for t in entry[1]:
+            self._tables[t].add(key)
+        while len(self._data) > self.max_entries or self._rows > self.max_rows:
+            k, e = self._data.popitem(last=False)
+            self._drop(k, e)
+            self.evictions += 1
+
+    def _drop(self, key, entry):
+        # 调用方须持有self._lock，key已从self._data中移除
+        self._rows -= entry[4]
+        for t in entry[1]:
+            keys = self._tables.get(t)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tables[t]
+
+    def invalidate(self, tables):
+        """
+        使引用了tables的缓存失效
+        :param tables: 表名集合，包含'*'时清空全部缓存
+        :return: None
+        """
+        with self._lock:
+            if '*' in tables:
+                self._generations['*'] += 1
+                self.invalidations += len(self._data)
+                self._data.clear()
+                self._tables.clear()
+                self._rows = 0
+                return
+            for t in tables:
+                self._generations[t] += 1
+                for key in self._tables.pop(t, ()):
+                    entry = self._data.pop(key, None)
+                    if entry is not None:
+                        self._drop(key, entry)
+                        self.invalidations += 1
+
+    def clear(self):
+        self.invalidate(set(['*']))
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return Dict(hits=self.hits, misses=self.misses, hit_rate=float(self.hits) / total if total else 0.0,
+                        evictions=self.evictions, invalidations=self.invalidations,
+                        size=len(self._data), rows=self._rows, max_entries=self.max_entries, max_rows=self.max_rows)
+
+
+_result_cache = None
+
+
+def enable_cache(max_entries=10000, max_rows=1000000, ttl=None):
+    """
+    开启查询结果缓存。只有传入cache_ttl、匹配cache_pattern或设置了默认ttl的select才会被缓存；
+    update/insert修改的表会使相关缓存失效，事务中的修改在提交后失效。
+    只能感知本进程内通过db模块的写操作。
+    :param max_entries: 最多缓存的结果数
+    :param max_rows: 所有结果的总行数上限
+    :param ttl: 默认TTL秒数
+    :return: None
+
+    >>> import sqlite3
+    >>> module = sys.modules[__name__]
+    >>> path = tempfile.mktemp()
+    >>> saved, module.engine = module.engine, _Engine(_sqlite_connect(path))
+    >>> update('create table t (id int primary key, v int)')
+    -1
+    >>> insert_many('t', [(1, 10), (2, 20), (3, 30)], columns=('id', 'v'))
+    3
+    >>> enable_cache(max_entries=2, max_rows=3)
+    >>> def v(id, ttl=60):
+    ...     return select_int('select v from t where id=?', id, cache_ttl=ttl)
+    >>> def bypass(sql):
+    ...     # 不经过db模块的修改，缓存感知不到
+    ...     conn = sqlite3.connect(path)
+    ...     conn.execute(sql)
+    ...     conn.commit()
+    ...     conn.close()
+
+    TTL内命中缓存，过期后重新查询：
+    >>> v(1, 0.1)
+    10
+    >>> bypass('update t set v=11 where id=1')
+    >>> v(1, 0.1)
+    10
+    >>> time.sleep(0.15)
+    >>> v(1, 0.1)
+    11
+
+    update使引用该表的缓存失效：
+    >>> n = update('update t set v=? where id=?', 12, 1)
+    >>> v(1)
+    12
+
+    事务中的修改在提交后才使缓存失效：
+    >>> v(2)
+    20
+    >>> with transaction():
+    ...     n = update('update t set v=21 where id=2')
+    ...     cache_stats().size
+    2
+    >>> cache_stats().size, v(2)
+    (0, 21)
+
+    按max_entries和max_rows淘汰最久未使用的结果：
+    >>> v(1), v(2), v(3), cache_stats().size
+    (12, 21, 30, 2)
+    >>> len(select('select * from t', cache_ttl=60)), cache_stats().size, cache_stats().rows
+    (3, 1, 3)
+    >>> disable_cache()
+    >>> module.engine = saved
+    >>> os.remove(path)
+    """
+    global _result_cache
+    _result_cache = _ResultCache(max_entries, max_rows, ttl)
+
+
+def disable_cache():
+    global _result_cache
+    _result_cache = None
+
+
+def cache_pattern(pattern, ttl):
+    """
+    匹配正则pattern的select使用ttl秒的缓存，ttl为0时不缓存，先添加的规则优先
+    :return: None
+    """
+    if _result_cache is None:
+        raise DBError("Result cache is not enabled.")
+    _result_cache.add_pattern(pattern, ttl)
+
+
+def clear_cache():
+    if _result_cache is not None:
+        _result_cache.clear()
+
+
+def cache_stats():
+    """
+    查询结果缓存的命中率等统计
+    :return: Dict，未开启缓存时为None
+    """
+    return _result_cache.stats() if _result_cache is not None else None
+
+
+def _after_write(tables):
+    """
+    写操作后记录写入时间（读写分离的粘滞），并使结果缓存失效，事务中推迟到提交之后
+    """
+    global _db_ctx
+    _db_ctx.last_write = time.time()
+    if _result_cache is None:
+        return
+    if _db_ctx.transactions == 0:
+        _result_cache.invalidate(tables)
+    else:
+        _db_ctx.invalidations.update(tables)
+
+
+def _query(sql, first, args, kw):
+    ttl = kw.pop('cache_ttl', None)
+    if kw:
+        raise TypeError('unexpected keyword arguments: %s' % ', '.join(kw.keys()))
+    if _result_cache is not None:
+        return _result_cache.select(sql, first, args, ttl)
+    return _select(sql, first, *args)
+
+
+# @with_connection
+def select_one(sql, *args, **kw):
+    """
+    :param kw: cache_ttl，开启了结果缓存时本次查询的TTL秒数
+    """
+    return _query(sql, True, args, kw)
+
+
+# @with_connection
+def select_int(sql, *args, **kw):
+    """
+    :param kw: cache_ttl，开启了结果缓存时本次查询的TTL秒数
+    :return: 第一行第一列的值，没有结果时返回None
+    """
+    if _result_cache is None and not kw:
+        return select_scalar(sql, *args)
+    d = _query(sql, True, args, kw)
+    if d is None:
+        return None
+    if len(d) != 1:
+        raise MultiColumnsError('Expect only one column.')
+    return d.values()[0]
+
+
+def select_scalar(sql, *args):
+    """
+    直接返回第一行第一列的值，不构造行对象，没有结果时返回None
+    :return: 单个值
+    """
+    names, values = _read_values(sql, True, args)
+    if len(names) != 1:
+        raise MultiColumnsError('Expect only one column.')
+    return values[0] if values else None
+
+
+def select_column(sql, *args, **kw):
+    """
+    返回单列结果的list，不构造行对象
+    :param dtype: array.array类型码，给出时返回array.array
+    :return: list或array.array
+    """
+    dtype = kw.pop('dtype', None)
+    if kw:
+        raise TypeError('unexpected keyword arguments: %s' % ', '.join(kw.keys()))
+    names, values = _read_values(sql, False, args)
+    if len(names) != 1:
+        raise MultiColumnsError('Expect only one column.')
+    if dtype is not None:
+        return array.array(dtype, [v[0] for v in values])
+    return [v[0] for v in values]
+
+
+# @with_connection
+def select(sql, *args, **kw):
+    """
+    :param kw: cache_ttl，开启了结果缓存时本次查询的TTL秒数
+    """
+    return _query(sql, False, args, kw)
+
+
+def select_parallel(queries, max_workers=None, deadline=None, return_exceptions=False):
+    """
+    在多个连接上并发执行互相独立的select，结果按输入顺序返回。
+    每个worker线程有自己的_db_ctx，从连接池取连接；调用者所在的事务对这些查询不可见。
+    rows1, rows2 = select_parallel([('select * from a where id=?', (1,)), ('select count(*) from b', ())])
+    :param queries: [(sql, args), ...]，也可以直接是sql字符串
+    :param max_workers: 最多同时执行的查询数，默认为查询数（不超过16）
+    :param deadline: 总的超时秒数，到时尚未完成的查询被取消（已开始执行的查询在后台执行完后丢弃结果）
+    :param return_exceptions: 为True时失败的查询在对应位置返回异常对象，否则抛出第一个失败的查询的异常
+    :return: list
+    """
+    global _db_ctx
+    queries = [(q, ()) if isinstance(q, basestring) else (q[0], tuple(q[1])) for q in queries]
+    n = len(queries)
+    if n == 0:
+        return []
+    if max_workers is None:
+        max_workers = min(n, 16)
+    pending = object()
+    results = [pending] * n
+    # 失败的查询的exc_info
+    errors = [None] * n
+    state = dict(next=0, remaining=n, cancelled=False)
+    lock = threading.Lock()
+    done = threading.Event()
+    # worker沿用调用者的分片和读写分离的粘滞状态
+    eng, last_write = _db_ctx.engine, _db_ctx.last_write
+
+    def run(sql, args):
+        if eng is None:
+            return select(sql, *args)
+        with _EngineCtx(eng):
+            return select(sql, *args)
+
+    def worker():
+        _db_ctx.last_write = last_write
+        while True:
+            with lock:
+                if state['cancelled'] or state['next'] >= n:
+                    return
+                i = state['next']
+                state['next'] += 1
+            r, error = None, None
+            try:
+                r = run(*queries[i])
+            except Exception:
+                error = sys.exc_info()
+            with lock:
+                if results[i] is pending:
+                    results[i], errors[i] = r, error
+                state['remaining'] -= 1
+                if state['remaining'] == 0:
+                    done.set()
+
+    for i in range(min(max_workers, n)):
+        t = threading.Thread(target=worker, name='select_parallel-%d' % i)
+        t.daemon = True
+        t.start()
+    if not done.wait(deadline):
+        with lock:
+            state['cancelled'] = True
+            for i in range(n):
+                if results[i] is pending:
+                    results[i] = None
+                    errors[i] = (QueryTimeoutError, QueryTimeoutError(
+                        'Query %d did not finish within %s seconds: %s' % (i, deadline, queries[i][0])), None)
+    for i, error in enumerate(errors):
+        if error is not None:
+            if not return_exceptions:
+                raise error[0], error[1], error[2]
+            results[i] = error[1]
+    return results
+
+# 流式查询：使用非缓冲cursor逐批fetchmany，内存占用与结果集大小无关
+class _StreamCtx(object):
+    """
+    stream()返回的对象，可用于with和for。
+    不在事务中时独占一条连接，读完或close()后归还连接池；在事务中时使用事务连接，
+    读完或close()之前该连接上不能执行其他语句。
+    """
+    def __init__(self, sql, args, batch):
+        self.sql = _statement(sql)
+        self.args = args
+        self.batch = batch
+        self.cursor = None
+        self.names = []
+        self._conn = None
+        self._engine = None
+        self._owned = False
+        self._exhausted = False
+        self._closed = False
+
+    def _open(self):
+        global _db_ctx
+        if self._closed:
+            raise DBError('Stream is closed.')
+        if self.cursor is not None:
+            return
+        if _sql_log_mode == 'all':
+            _log_sql(self.sql, self.args, 0.0, 'stream', False)
+        if _db_ctx.is_init() and _db_ctx.transactions > 0:
+            self._conn = _db_ctx.connection._connect()
+            self._execute()
+        else:
+            self._owned = True
+            replica = _pick_replica()
+            if replica is not None:
+                try:
+                    _replicas.run(replica, self._execute, replica.engine)
+                except _ReplicaDown:
+                    replica = None
+            if replica is None:
+                self._execute(_db_ctx.engine if _db_ctx.engine is not None else engine)
+        if self.cursor.description:
+            self.names = [x[0] for x in self.cursor.description]
+
+    def _execute(self, eng=None):
         try:
-            self.cursor = _db_ctx.cursor()
-            self.cursor.execute(sql, args)
-            if self.cursor.description:
-                self.names = [x[0] for x in self.cursor.description]
-            #self.data = [Dict(self.names,x) for x in self.cursor.fetchmany(self.batch)]
+            if eng is not None:
+                self._engine = eng
+                self._conn = eng.connect()
+            self.cursor = self._conn.cursor(buffered=False)
+            self.cursor.execute(self.sql, self.args)
         except:
-            del self
+            cursor, self.cursor = self.cursor, None
+            if cursor is not None:
+                _close_cursor(cursor)
+            if eng is not None and self._conn is not None:
+                conn, self._conn = self._conn, None
+                eng.release(conn, discard=True)
+            raise
 
-    def __iter__(self):
+    def __enter__(self):
+        self._open()
         return self
 
-    def next(self):
-        self.data = [Dict(self.names,x) for x in self.cursor.fetchmany(self.batch)]
-        if len(self.data) == 0:
-            raise StopIteration
-        return self.data
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        exception_logging(exc_type, exc_value, exc_tb, "_StreamCtx.__exit__")
+        self.close()
+
+    def raw_batches(self):
+        """
+        按批迭代驱动返回的values（tuple），不构造行对象，列名见self.names
+        """
+        if self._closed:
+            return
+        self._open()
+        try:
+            while True:
+                values = self.cursor.fetchmany(self.batch)
+                if not values:
+                    self._exhausted = True
+                    break
+                yield values
+        finally:
+            self.close()
+
+    def batches(self):
+        """
+        按批迭代，每次返回最多batch行的list
+        """
+        make = None
+        for values in self.raw_batches():
+            if make is None:
+                make = _row_maker(self.names)
+            yield [make(x) for x in values]
 
-    def __getitem__(self, item):
-        if item >= len(self.data):
-            raise IndexError("index out of range")
-        return self.data[item]
+    def __iter__(self):
+        for rows in self.batches():
+            for row in rows:
+                yield row
 
-    def __del__(self):
-        global _db_ctx
-        if self.should_cleanup:
-            if self.cursor:
-                cur = self.cursor
-                self.cursor = None
-                cur.close()
-            _db_ctx.cleanup()
+    def close(self):
+        """
+        关闭cursor并释放连接。未读完就关闭时，独占的连接直接丢弃，比读完剩余结果代价小
+        :return: None
+        """
+        if self._closed:
+            return
+        self._closed = True
+        cursor, self.cursor = self.cursor, None
+        conn, self._conn = self._conn, None
+        if cursor is not None and not self._exhausted and not self._owned:
+            # 事务连接不能丢弃，只能读完剩余结果
+            consume = getattr(conn, 'consume_results', None)
+            if consume:
+                consume()
+        if cursor is not None:
+            _close_cursor(cursor)
+        if conn is not None and self._owned:
+            self._engine.release(conn, discard=not self._exhausted)
+
+
+def stream(sql, *args, **kw):
+    """
+    流式查询大结果集。
+    with stream('select * from user where id > ?', 0, batch=500) as rows:
+        for row in rows:
+            ...
+    或按批处理：for batch in stream(sql).batches(): ...
+    :param sql: sql
+    :param args: sql参数
+    :param batch: 每次fetchmany的行数，默认1000
+    :return: _StreamCtx
+    """
+    return _StreamCtx(sql, args, kw.pop('batch', 1000))
+
+
+class _CountingWriter(object):
+    """
+    统计写入目标文件的字节数
+    """
+    def __init__(self, fp):
+        self.fp = fp
+        self.bytes = 0
+
+    def write(self, data):
+        self.fp.write(data)
+        self.bytes += len(data)
+
+    def flush(self):
+        self.fp.flush()
+
+
+def _json_default(v):
+    if isinstance(v, (datetime.datetime, datetime.date, datetime.time)):
+        return v.isoformat()
+    if isinstance(v, datetime.timedelta):
+        return v.total_seconds()
+    if isinstance(v, decimal.Decimal):
+        return str(v)
+    if isinstance(v, bytearray):
+        return str(v).decode('utf-8')
+    raise TypeError('%r is not JSON serializable' % (v,))
+
+
+def _csv_value(v):
+    if isinstance(v, unicode):
+        return v.encode('utf-8')
+    if isinstance(v, bytearray):
+        return str(v)
+    return v
+
+
+def export(fp_or_path, sql, *args, **kw):
+    """
+    把查询结果流式写入csv或JSON Lines文件：使用非缓冲cursor逐批fetchmany，
+    直接序列化驱动返回的tuple，不构造行对象，内存占用与结果集大小无关。
+    :param fp_or_path: 文件路径或以二进制方式打开的文件对象（不会被关闭）
+    :param sql: select语句
+    :param args: sql参数
+    :param format: 'csv'或'jsonl'
+    :param batch: 每次fetchmany的行数
+    :param gzip: 是否gzip压缩，默认按路径是否以.gz结尾
+    :param header: csv是否写表头，默认True
+    :param buffer_size: 缓冲的字节数，攒够后一次写入
+    :return: Dict(rows=行数, bytes=写入文件的字节数, raw_bytes=压缩前的字节数)
+    """
+    fmt = kw.pop('format', 'csv')
+    batch = kw.pop('batch', 1000)
+    compress = kw.pop('gzip', None)
+    header = kw.pop('header', True)
+    buffer_size = kw.pop('buffer_size', 1024 * 1024)
+    if kw:
+        raise TypeError('unexpected keyword arguments: %s' % ', '.join(kw.keys()))
+    if fmt not in ('csv', 'jsonl'):
+        raise DBError('Unsupported export format: %s' % fmt)
+    should_close = isinstance(fp_or_path, basestring)
+    if compress is None:
+        compress = should_close and fp_or_path.endswith('.gz')
+    fp = open(fp_or_path, 'wb') if should_close else fp_or_path
+    start = time.time()
+    rows = raw_bytes = 0
+    try:
+        out = _CountingWriter(fp)
+        target = gzip.GzipFile(fileobj=out, mode='wb') if compress else out
+        buf = cStringIO.StringIO()
+        write_rows = None
+        stream_ctx = _StreamCtx(sql, args, batch)
+        for values in stream_ctx.raw_batches():
+            if write_rows is None:
+                names = stream_ctx.names
+                if fmt == 'csv':
+                    writer = csv.writer(buf)
+                    if header:
+                        writer.writerow([_csv_value(n) for n in names])
+                    write_rows = lambda values: writer.writerows([[_csv_value(v) for v in r] for r in values])
+                else:
+                    encode = json.JSONEncoder(default=_json_default, separators=(',', ':')).encode
+                    # 列名只编码一次，每行由'"列名":'前缀和编码后的值拼接，不构造dict
+                    keys = [encode(n) + ':' for n in names]
+                    write_rows = lambda values: buf.write(''.join(
+                        ['{%s}\n' % ','.join([k + encode(v) for k, v in itertools.izip(keys, r)]) for r in values]))
+            write_rows(values)
+            rows += len(values)
+            if buf.tell() >= buffer_size:
+                data = buf.getvalue()
+                target.write(data)
+                raw_bytes += len(data)
+                buf.seek(0)
+                buf.truncate()
+        if write_rows is None and fmt == 'csv' and header and stream_ctx.names:
+            # 空结果集也写表头
+            csv.writer(buf).writerow([_csv_value(n) for n in stream_ctx.names])
+        data = buf.getvalue()
+        if data:
+            target.write(data)
+            raw_bytes += len(data)
+        if compress:
+            target.close()
+        out.flush()
+    finally:
+        if should_close:
+            fp.close()
+    _profiling(start, 'export %d rows: %s' % (rows, sql))
+    return Dict(rows=rows, bytes=out.bytes, raw_bytes=raw_bytes)
+
+
+# array.array支持的类型码
+_ARRAY_TYPECODES = 'cbBuhHiIlLfd'
+
+
+def _is_typecode(dtype):
+    return isinstance(dtype, basestring) and len(dtype) == 1 and dtype in _ARRAY_TYPECODES
+
+
+def _new_column(values, dtype):
+    """
+    按dtype或第一批数据的类型建立列容器：整数和浮点数用array.array，其他用list
+    :return: (column, 是否显式指定了类型)
+    """
+    if dtype is not None:
+        if _is_typecode(dtype):
+            return array.array(dtype), True
+        return [], True
+    for v in values:
+        if v is None:
+            continue
+        if isinstance(v, (int, long)) and not isinstance(v, bool):
+            return array.array('l'), False
+        if isinstance(v, float):
+            return array.array('d'), False
+        break
+    return [], False
+
+
+def _extend_column(name, column, explicit, values):
+    if isinstance(column, list):
+        column.extend(values)
+        return column
+    n = len(column)
+    try:
+        column.extend(values)
+    except (TypeError, OverflowError):
+        if explicit:
+            raise DBError('Column %s can not be stored as array(%r).' % (name, column.typecode))
+        # 出现NULL或超出范围的值，退回list
+        column = column.tolist()[:n]
+        column.extend(values)
+    return column
+
+
+def select_columns(sql, *args, **kw):
+    """
+    按列返回查询结果，逐批fetchmany后按列转置，不为每行创建对象。
+    整数和浮点数列为array.array，安装了numpy时转换为numpy数组，其他列为list。
+    :param sql: sql
+    :param args: sql参数
+    :param dtypes: {列名: array类型码或numpy dtype}，指定时不再按数据推断
+    :param batch: 每次fetchmany的行数，默认10000
+    :param as_numpy: 是否转换为numpy数组，默认在安装了numpy时转换
+    :return: Dict，列名 -> 列数据
+    """
+    dtypes = kw.pop('dtypes', None) or {}
+    batch = kw.pop('batch', 10000)
+    as_numpy = kw.pop('as_numpy', numpy is not None)
+    if as_numpy and numpy is None:
+        raise DBError('numpy is not installed.')
+    return _read(_execute_columns, _statement(sql), args, dtypes, batch, as_numpy)
+
+
+def _execute_columns(conn, sql, args, dtypes, batch, as_numpy):
+    cursor = None
+    start = time.time()
+    rows, failed = 0, True
+    try:
+        cursor = conn.cursor(buffered=False)
+        cursor.execute(sql, args)
+        names = [x[0] for x in cursor.description] if cursor.description else []
+        columns = None
+        while True:
+            values = cursor.fetchmany(batch)
+            if not values:
+                break
+            rows += len(values)
+            chunks = zip(*values)
+            if columns is None:
+                columns = [_new_column(chunk, dtypes.get(name)) for name, chunk in zip(names, chunks)]
+            columns = [(_extend_column(name, column, explicit, chunk), explicit)
+                       for name, (column, explicit), chunk in zip(names, columns, chunks)]
+        failed = False
+    finally:
+        if cursor:
+            cursor.close()
+        _finish(sql, args, start, rows, failed)
+    if columns is None:
+        columns = [(array.array(dtypes[name]) if _is_typecode(dtypes.get(name)) else [], False)
+                   for name in names]
+    result = Dict()
+    for name, (column, explicit) in zip(names, columns):
+        if as_numpy:
+            if isinstance(column, array.array):
+                column = numpy.frombuffer(column, dtype=column.typecode) if column \
+                    else numpy.zeros(0, dtype=column.typecode)
+            elif dtypes.get(name) is not None:
+                column = numpy.asarray(column, dtype=dtypes[name])
+        elif isinstance(column, list) and dtypes.get(name) is not None:
+            raise DBError('dtype %r of column %s requires numpy.' % (dtypes[name], name))
+        result[name] = column
+    return result
+
+
+# keyset分页：按order by列的上一页最后一行的值定位，代价与页码无关
+_TABLE_RE = re.compile(r'^\s*[`\w.]+\s*$')
+
+
+def _order_spec(order_by):
+    """
+    >>> _order_spec('-created_at, id')
+    [('created_at', True), ('id', False)]
+    """
+    if isinstance(order_by, basestring):
+        order_by = order_by.split(',')
+    spec = []
+    for col in order_by:
+        col = col.strip()
+        spec.append((col[1:], True) if col.startswith('-') else (col, False))
+    return spec
 
 
+def _cursor_value(v):
+    if isinstance(v, datetime.datetime):
+        return {'dt': v.strftime('%Y-%m-%dT%H:%M:%S.%f')}
+    if isinstance(v, datetime.date):
+        return {'d': v.strftime('%Y-%m-%d')}
+    if isinstance(v, decimal.Decimal):
+        return {'n': str(v)}
+    raise TypeError('%r is not supported in a page cursor.' % (v,))
+
+
+def _cursor_hook(d):
+    if 'dt' in d:
+        return datetime.datetime.strptime(d['dt'], '%Y-%m-%dT%H:%M:%S.%f')
+    if 'd' in d:
+        return datetime.datetime.strptime(d['d'], '%Y-%m-%d').date()
+    if 'n' in d:
+        return decimal.Decimal(d['n'])
+    return d
+
+
+def _encode_cursor(columns, values):
+    return base64.urlsafe_b64encode(json.dumps([columns, values], default=_cursor_value, separators=(',', ':')))
+
+
+def _decode_cursor(token, columns):
+    try:
+        cols, values = json.loads(base64.urlsafe_b64decode(str(token)), object_hook=_cursor_hook)
+    except (TypeError, ValueError):
+        raise DBError('Invalid page cursor.')
+    if cols != columns or len(values) != len(columns):
+        raise DBError('Page cursor does not match order_by %s.' % ', '.join(columns))
+    return values
+
+
+def _keyset_where(spec, values):
+    """
+    (c1 > v1) or (c1 = v1 and c2 > v2) or ...，降序的列用<
+    >>> _keyset_where([('a', False), ('b', True)], [1, 2])
+    ('(a > ?) or (a = ? and b < ?)', [1, 1, 2])
+    """
+    terms, args = [], []
+    for i, (col, desc) in enumerate(spec):
+        conds = ['%s = ?' % c for c, d in spec[:i]]
+        conds.append('%s %s ?' % (col, '<' if desc else '>'))
+        terms.append('(%s)' % ' and '.join(conds))
+        args.extend(values[:i])
+        args.append(values[i])
+    return ' or '.join(terms), args
+
+
+def paginate(table_or_sql, *args, **kw):
+    """
+    keyset分页，替代limit ? offset ?。
+    rows, cursor = paginate('user', order_by='-created_at, id', limit=20)
+    rows, cursor = paginate('select * from user where status=?', 1, order_by='id', after=cursor, limit=20)
+    :param table_or_sql: 表名，或select语句（作为子查询）
+    :param args: select语句的参数
+    :param order_by: 排序列，逗号分隔的字符串或序列，-前缀表示降序；最后一列必须唯一（如主键），且出现在结果中
+    :param after: 上一页返回的cursor，None表示第一页
+    :param limit: 每页行数
+    :return: (rows, next_cursor)，没有下一页时next_cursor为None
+    """
+    order_by = kw.pop('order_by', 'id')
+    after = kw.pop('after', None)
+    limit = kw.pop('limit', 20)
+    if kw:
+        raise TypeError('unexpected keyword arguments: %s' % ', '.join(kw.keys()))
+    spec = _order_spec(order_by)
+    columns = [col for col, desc in spec]
+    if _TABLE_RE.match(table_or_sql):
+        sql, args = 'select * from %s' % table_or_sql.strip(), []
+    else:
+        sql, args = 'select * from (%s) as _page' % table_or_sql, list(args)
+    if after is not None:
+        where, where_args = _keyset_where(spec, _decode_cursor(after, columns))
+        sql = '%s where %s' % (sql, where)
+        args.extend(where_args)
+    sql = '%s order by %s limit %d' % (
+        sql, ', '.join('%s%s' % (col, ' desc' if desc else '') for col, desc in spec), limit + 1)
+    # 多取一行判断是否还有下一页
+    rows = select(sql, *args)
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, _encode_cursor(columns, [last[col] for col in columns])
+
+
+def scan(table, key='id', chunk=1000, columns='*'):
+    """
+    按主键范围分批遍历整张表：每批是一条where key > ? order by key limit chunk的select，
+    连接在批之间归还连接池，不会长时间占用一个cursor
+    for row in scan('user', chunk=500): ...
+    :param table: 表名
+    :param key: 唯一且有索引的列，通常为主键
+    :param chunk: 每批行数
+    :param columns: select的列，必须包含key
+    :return: 逐行返回的generator
+    """
+    first = 'select %s from %s order by %s limit %d' % (columns, table, key, chunk)
+    rest = 'select %s from %s where %s > ? order by %s limit %d' % (columns, table, key, key, chunk)
+    rows = select(first)
+    while rows:
+        for row in rows:
+            yield row
+        if len(rows) < chunk:
+            return
+        rows = select(rest, rows[-1][key])
+
 
 @with_connection
 def _update(sql, *args):
@@ -382,25 +2857,279 @@ def _update(sql, *args):
     :return:
     """
     global _db_ctx
-    sql = sql.replace('?', '%s')
+    sql = _statement(sql)
     cursor = None
-    logging.info("Sql: %s, Args: %s" % (sql, args))
+    should_close = True
+    start = time.time()
+    r, failed = 0, True
     try:
-        cursor = _db_ctx.cursor()
+        cursor, should_close = _db_ctx.statement_cursor(sql)
         cursor.execute(sql, args)
         r = cursor.rowcount
         # 当不处于事务状态下，需要提交
         if _db_ctx.transactions == 0:
             _db_ctx.connection.commit()
-            logging.info("auto commit")
+            logger.debug("auto commit")
+        failed = False
+        _after_write(_write_tables(sql))
         return r
+    except:
+        if cursor and not should_close:
+            _db_ctx.connection.discard_cursor(sql)
+        raise
     finally:
-        if cursor:
+        if cursor and should_close:
             cursor.close()
+        _finish(sql, args, start, max(r, 0), failed)
+
+
+# group commit：多个线程的自动提交写操作由少数writer线程合并到一个事务中提交，减少commit次数
+class _PendingWrite(object):
+    __slots__ = ('sql', 'args', 'result', 'error', 'done')
+
+    def __init__(self, sql, args):
+        self.sql = sql
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class _GroupCommitter(object):
+    """
+    >>> class Conn(_SqliteConnection):
+    ...     fail_commit = False
+    ...     def commit(self):
+    ...         if Conn.fail_commit:
+    ...             raise IOError('commit failed')
+    ...         self._conn.commit()
+    >>> def writers(*statements):
+    ...     results = [None] * len(statements)
+    ...     def work(i):
+    ...         try:
+    ...             results[i] = update(*statements[i])
+    ...         except Exception as e:
+    ...             results[i] = e.__class__.__name__
+    ...     threads = [threading.Thread(target=work, args=(i,)) for i in range(len(statements))]
+    ...     for t in threads:
+    ...         t.start()
+    ...     for t in threads:
+    ...         t.join(5)
+    ...     return results
+    >>> module = sys.modules[__name__]
+    >>> path = tempfile.mktemp()
+    >>> saved, module.engine = module.engine, _Engine(lambda: Conn(path))
+    >>> update('create table t (id int primary key, v int)')
+    -1
+    >>> insert_many('t', [(1, 0), (2, 0), (3, 0)], columns=('id', 'v'))
+    3
+
+    一批中的每个调用者得到自己的影响行数：
+    >>> enable_group_commit(max_delay=1, max_batch=3)
+    >>> writers(*[('update t set v=v+1 where id<=?', k) for k in (1, 2, 3)])
+    [1, 2, 3]
+    >>> st = group_commit_stats()
+    >>> st.batches, st.writes, st.fallbacks
+    (1, 3, 0)
+
+    某条语句失败时整批回滚后逐条重做，只有失败的调用者得到异常：
+    >>> writers(('insert into t values (4, 0)',), ('insert into t values (1, 0)',), ('insert into t values (5, 0)',))
+    [1, 'IntegrityError', 1]
+    >>> group_commit_stats().fallbacks, select_int('select count(*) from t')
+    (1, 5)
+
+    提交失败时整批的调用者都得到该异常：
+    >>> Conn.fail_commit = True
+    >>> writers(*[('update t set v=0 where id=?', k) for k in (1, 2, 3)])
+    ['IOError', 'IOError', 'IOError']
+    >>> Conn.fail_commit = False
+    >>> select_int('select sum(v) from t')
+    6
+
+    关闭时已排队的写操作执行完，没有调用者一直等待：
+    >>> disable_group_commit()
+    >>> enable_group_commit(max_delay=5, max_batch=10)
+    >>> t = threading.Timer(0.2, disable_group_commit)
+    >>> t.start()
+    >>> start = time.time()
+    >>> writers(*[('update t set v=v+1 where id=?', k) for k in (1, 2, 3)]), time.time() - start < 2
+    ([1, 1, 1], True)
+    >>> t.join()
+    >>> group_commit_stats() is None
+    True
+    >>> module.engine = saved
+    >>> os.remove(path)
+    """
+    def __init__(self, writers, max_delay, max_batch):
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self.batches = 0
+        self.writes = 0
+        self.fallbacks = 0
+        self._threads = []
+        for i in range(writers):
+            t = threading.Thread(target=self._serve, name='group-commit-%d' % i)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, sql, args):
+        """
+        提交一条写语句并等待它所在的批提交完成，已关闭时直接自动提交执行
+        :return: 该语句的影响行数
+        """
+        w = _PendingWrite(sql, args)
+        with self._lock:
+            closed = self._closed
+            if not closed:
+                self._queue.put(w)
+        if closed:
+            return _update(sql, *args)
+        w.done.wait()
+        if w.error is not None:
+            raise w.error[0], w.error[1], w.error[2]
+        _db_ctx.last_write = time.time()
+        return w.result
+
+    def _serve(self):
+        stopping = False
+        while not stopping:
+            w = self._queue.get()
+            if w is None:
+                return
+            batch = [w]
+            deadline = time.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    # 先取走已排队的，再等到max_delay为止
+                    w = self._queue.get_nowait()
+                except Queue.Empty:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        w = self._queue.get(True, timeout)
+                    except Queue.Empty:
+                        break
+                if w is None:
+                    stopping = True
+                    break
+                batch.append(w)
+            self._commit(batch)
+
+    def _commit(self, batch):
+        statement_failed = False
+        try:
+            with transaction():
+                for w in batch:
+                    try:
+                        w.result = _update(w.sql, *w.args)
+                    except Exception:
+                        statement_failed = True
+                        raise
+            with self._lock:
+                self.batches += 1
+                self.writes += len(batch)
+        except Exception:
+            if not statement_failed:
+                # 提交失败：整批的调用者都得到该异常
+                error = sys.exc_info()
+                for w in batch:
+                    w.error = error
+            else:
+                # 某条语句失败，整批已回滚：逐条自动提交，每个调用者得到自己的结果或异常
+                logger.warning('group commit batch of %d failed, retry one by one.', len(batch))
+                with self._lock:
+                    self.fallbacks += 1
+                for w in batch:
+                    try:
+                        w.result = _update(w.sql, *w.args)
+                        w.error = None
+                    except Exception:
+                        w.error = sys.exc_info()
+        finally:
+            for w in batch:
+                w.done.set()
+
+    def stop(self):
+        with self._lock:
+            self._closed = True
+            for t in self._threads:
+                self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        # writer线程异常退出时队列中可能还有写操作，在当前线程执行完，调用者不会一直等待
+        batch = []
+        while True:
+            try:
+                w = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+            if w is not None:
+                batch.append(w)
+        if batch:
+            self._commit(batch)
+
+    def stats(self):
+        with self._lock:
+            return Dict(batches=self.batches, writes=self.writes, fallbacks=self.fallbacks,
+                        avg_batch=float(self.writes) / self.batches if self.batches else 0.0,
+                        queued=self._queue.qsize(), max_delay=self.max_delay, max_batch=self.max_batch)
+
+
+_group_commit = None
+
+
+def enable_group_commit(writers=1, max_delay=0.002, max_batch=100):
+    """
+    开启group commit：不在事务中的update()/insert()交给writer线程，与其他线程的写操作合并提交。
+    调用者阻塞到所在的批提交后返回自己的影响行数；批中某条语句失败时整批回滚后逐条重做，
+    每个调用者得到自己的结果或异常。写入延迟最多增加max_delay。
+    :param writers: writer线程（连接）数
+    :param max_delay: 一批等待后续写操作的最长秒数
+    :param max_batch: 一批最多的语句数
+    :return: None
+    """
+    global _group_commit
+    if _group_commit is not None:
+        raise DBError("Group commit is already enabled.")
+    _group_commit = _GroupCommitter(writers, max_delay, max_batch)
+
+
+def disable_group_commit():
+    """
+    关闭group commit，已排队的写操作执行完后writer线程退出，之后提交的写操作直接自动提交
+    """
+    global _group_commit
+    committer, _group_commit = _group_commit, None
+    if committer is not None:
+        committer.stop()
+
+
+def group_commit_stats():
+    """
+    :return: Dict，未开启时为None
+    """
+    return _group_commit.stats() if _group_commit is not None else None
+
+
+def _write(sql, args):
+    global _db_ctx
+    if _pid != os.getpid():
+        # fork出的子进程中没有父进程的writer线程，先重建
+        _after_fork()
+    # 只读一次，disable_group_commit()可能在其他线程中同时执行
+    committer = _group_commit
+    if committer is not None and _db_ctx.transactions == 0 and _db_ctx.engine is None:
+        return committer.submit(sql, args)
+    return _update(sql, *args)
 
 
 def update(sql, *args):
-    return _update(sql, *args)
+    return _write(sql, args)
 
 
 def insert(table, **kw):
@@ -427,7 +3156,343 @@ def insert(table, **kw):
     cols, args = zip(*kw.iteritems())
     sql = 'insert into %s (%s) values (%s)' % \
           (table, ','.join(['%s' % col for col in cols]), ','.join(['?' for i in range(len(cols))]))
-    return _update(sql, *args)
+    return _write(sql, args)
+
+
+def _estimate_size(value):
+    """
+    估算参数值在sql语句中占用的字节数（按转义和utf8编码的最坏情况）
+    """
+    if value is None:
+        return 4
+    if isinstance(value, unicode):
+        return len(value) * 3 + 2
+    if isinstance(value, str):
+        return len(value) * 2 + 2
+    return 24
+
+
+def _quote_name(name):
+    """
+    给表名或列名加反引号，已加的不重复加
+    >>> _quote_name('test.order'), _quote_name('`user`')
+    ('`test`.`order`', '`user`')
+    """
+    return '.'.join('`%s`' % part.strip('`') for part in name.split('.'))
+
+
+@with_connection
+def _insert_chunk(prefix, group, n, args):
+    """
+    执行一条n行的INSERT ... VALUES (...),(...)语句
+    :param prefix: 'insert into table (cols) values '
+    :param group: 单行的占位符'(%s,%s,...)'
+    :param n: 行数
+    :param args: 按行展开的参数
+    :return: 影响行数
+    """
+    global _db_ctx
+    cursor = None
+    start = time.time()
+    r, failed = 0, True
+    try:
+        cursor = _db_ctx.cursor()
+        cursor.execute(prefix + ','.join([group] * n), args)
+        r = cursor.rowcount
+        if _db_ctx.transactions == 0:
+            _db_ctx.connection.commit()
+            logger.debug("auto commit")
+        failed = False
+        _after_write(_write_tables(prefix))
+        return r
+    finally:
+        if cursor:
+            cursor.close()
+        _finish(prefix + group, '(%d rows)' % n, start, max(r, 0), failed)
+
+
+def insert_many(table, rows, columns=None, chunk_size=1000, max_packet=1024 * 1024):
+    """
+    批量插入，把rows切分为多行的INSERT ... VALUES (...),(...)语句执行。
+    不在事务中时每个chunk提交一次（已提交的chunk不会因后续chunk失败而回滚），在事务中时随事务一起提交。
+    :param table: 表名，与列名一样会加反引号
+    :param rows: dict或tuple的可迭代对象，可以是生成器
+    :param columns: 列名序列，rows为tuple时必须给出，为dict时默认取第一行的key
+    :param chunk_size: 每条语句最多插入的行数
+    :param max_packet: 每条语句的估算字节上限，应小于服务端max_allowed_packet
+    :return: 总影响行数
+    """
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        return 0
+    if isinstance(first, dict):
+        if columns is None:
+            columns = first.keys()
+        columns = tuple(columns)
+        values = lambda row: [row[col] for col in columns]
+    else:
+        if columns is None:
+            raise DBError('columns is required when rows are not dicts.')
+        columns = tuple(columns)
+
+        def values(row):
+            if len(row) != len(columns):
+                raise DBError('Expect %d values but got %d.' % (len(columns), len(row)))
+            return row
+    prefix = 'insert into %s (%s) values ' % (_quote_name(table), ','.join(_quote_name(col) for col in columns))
+    group = '(%s)' % ','.join(['%s'] * len(columns))
+    total = 0
+    with connection():
+        n, args, size = 0, [], len(prefix)
+        for row in itertools.chain([first], rows):
+            vals = values(row)
+            row_size = len(group) + 1 + sum(_estimate_size(v) for v in vals)
+            if n and (n >= chunk_size or size + row_size > max_packet):
+                total += _insert_chunk(prefix, group, n, args)
+                n, args, size = 0, [], len(prefix)
+            n += 1
+            args.extend(vals)
+            size += row_size
+        if n:
+            total += _insert_chunk(prefix, group, n, args)
+    return total
+
+
+@with_connection
+def _update_many(sql, seq_of_args):
+    global _db_ctx
+    sql = _statement(sql)
+    cursor = None
+    start = time.time()
+    r, failed = 0, True
+    try:
+        cursor = _db_ctx.cursor()
+        cursor.executemany(sql, seq_of_args)
+        r = cursor.rowcount
+        if _db_ctx.transactions == 0:
+            _db_ctx.connection.commit()
+            logger.debug("auto commit")
+        failed = False
+        _after_write(_write_tables(sql))
+        return r
+    finally:
+        if cursor:
+            cursor.close()
+        _finish(sql, '(%d rows)' % len(seq_of_args), start, max(r, 0), failed)
+
+
+def update_many(sql, seq_of_args):
+    """
+    用executemany批量执行同一条update/delete语句
+    :param sql: 语句，占位符为?
+    :param seq_of_args: 每次执行的参数序列
+    :return: 影响行数
+    """
+    seq_of_args = [tuple(args) for args in seq_of_args]
+    if not seq_of_args:
+        return 0
+    return _update_many(sql, seq_of_args)
+
+
+# 服务端或客户端不允许LOAD DATA LOCAL INFILE时的错误码
+_LOCAL_INFILE_ERRORS = (1148, 2068, 3948)
+
+
+def _local_infile_unsupported(e):
+    """
+    :return: e是否表示LOAD DATA LOCAL INFILE不可用：错误码在_LOCAL_INFILE_ERRORS中，
+             或驱动的DB-API NotSupportedError（各驱动的异常类不同，按类名判断）
+    >>> class NotSupportedError(Exception):
+    ...     pass
+    >>> class ProgrammingError(Exception):
+    ...     def __init__(self, errno):
+    ...         self.errno = errno
+    >>> [_local_infile_unsupported(e) for e in (NotSupportedError(), ProgrammingError(1148),
+    ...                                         ProgrammingError(1064), TypeError())]
+    [True, True, False, False]
+    """
+    if getattr(e, 'errno', None) in _LOCAL_INFILE_ERRORS:
+        return True
+    return any(c.__name__ == 'NotSupportedError' for c in type(e).__mro__)
+
+
+def _tsv_field(v):
+    """
+    LOAD DATA默认格式的字段：tab分隔，反斜杠转义，NULL写作反斜杠N
+    """
+    if v is None:
+        return '\\N'
+    if isinstance(v, bool):
+        return '1' if v else '0'
+    if isinstance(v, unicode):
+        v = v.encode('utf-8')
+    elif isinstance(v, float):
+        return repr(v)
+    elif not isinstance(v, str):
+        v = str(v)
+    return v.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r').replace('\0', '\\0')
+
+
+def _source_rows(source, columns, fmt, header, opened):
+    """
+    :param opened: 打开的文件对象追加到这个list中，由调用方关闭
+    :return: (columns, tuple行的迭代器)
+    """
+    if isinstance(source, basestring):
+        fp = open(source, 'rb')
+        opened.append(fp)
+        if source.endswith('.gz'):
+            fp = gzip.GzipFile(fileobj=fp, mode='rb')
+            opened.append(fp)
+        if fmt == 'csv':
+            rows = csv.reader(fp)
+            if header:
+                names = next(rows, None)
+                if columns is None and names is not None:
+                    columns = [name.decode('utf-8') for name in names]
+            if columns is None:
+                raise DBError('columns is required for csv files without header.')
+            return tuple(columns), (tuple([v.decode('utf-8') for v in r]) for r in rows)
+        if fmt != 'jsonl':
+            raise DBError('Unsupported bulk load format: %s' % fmt)
+        source = (json.loads(line) for line in fp if line.strip())
+    rows = iter(source)
+    first = next(rows, None)
+    if first is None:
+        return tuple(columns or ()), iter(())
+    if isinstance(first, dict):
+        columns = tuple(columns or first.keys())
+        return columns, (tuple(r[c] for c in columns) for r in itertools.chain([first], rows))
+    if columns is None:
+        raise DBError('columns is required when rows are not dicts.')
+    return tuple(columns), itertools.chain([first], rows)
+
+
+@with_connection
+def _load_data(sql, args, table):
+    global _db_ctx
+    cursor = None
+    start = time.time()
+    r, failed = 0, True
+    try:
+        cursor = _db_ctx.cursor()
+        cursor.execute(sql, args)
+        r = cursor.rowcount
+        if _db_ctx.transactions == 0:
+            _db_ctx.connection.commit()
+        failed = False
+        _after_write(set([_table_name(table)]))
+        return r
+    finally:
+        if cursor:
+            cursor.close()
+        _finish(sql, args, start, max(r, 0), failed)
+
+
+def _bulk_load_infile(table, columns, rows):
+    """
+    把rows写到临时文件，用LOAD DATA LOCAL INFILE导入
+    :return: (导入行数, 源行数)
+    """
+    fd, path = tempfile.mkstemp(prefix='transwarp-load-', suffix='.tsv')
+    try:
+        n = 0
+        with os.fdopen(fd, 'wb', 1024 * 1024) as f:
+            for row in rows:
+                f.write('\t'.join([_tsv_field(v) for v in row]))
+                f.write('\n')
+                n += 1
+        sql = 'load data local infile %%s into table %s character set utf8 (%s)' % (
+            _quote_name(table), ','.join(_quote_name(col) for col in columns))
+        return _load_data(sql, (path,), table), n
+    finally:
+        os.remove(path)
+
+
+def bulk_load(table, source, columns=None, format='csv', header=True, chunk_size=1000,
+              method='auto', progress=None, validate=True):
+    """
+    批量导入。服务端和驱动允许时使用LOAD DATA LOCAL INFILE（需要create_engine(..., allow_local_infile=True)），
+    否则退回到按chunk执行executemany的INSERT。整个导入在一个事务中，行数校验失败时回滚。
+    :param table: 表名
+    :param source: 文件路径（csv或jsonl，可以是.gz），或dict/tuple行的可迭代对象
+    :param columns: 列名序列；csv文件默认取表头，dict行默认取第一行的key
+    :param format: 文件格式，'csv'或'jsonl'
+    :param header: csv文件第一行是否为表头
+    :param chunk_size: executemany每批的行数
+    :param method: 'auto'、'load_data'或'executemany'
+    :param progress: progress(已导入行数)，每个chunk（LOAD DATA时为结束时）调用一次
+    :param validate: 导入行数与源行数不一致时抛出DBError并回滚
+    :return: Dict(rows=导入行数, method=实际使用的方法)
+
+    没有LOAD DATA时（如sqlite替身）method='auto'退回到executemany：
+    >>> path, src = tempfile.mktemp(), tempfile.mktemp(suffix='.csv')
+    >>> with open(src, 'wb') as f:
+    ...     f.write('id,name\\n1,a\\n2,b\\n3,c\\n')
+    >>> eng = _Engine(_sqlite_connect(path))
+    >>> done = []
+    >>> with _EngineCtx(eng):
+    ...     n = update('create table t (id int primary key, name text)')
+    ...     r = bulk_load('t', src, chunk_size=2, progress=done.append)
+    ...     names = select_column('select name from t order by id')
+    >>> r.method, r.rows, done, names, eng.local_infile
+    ('executemany', 3, [2, 3], [u'a', u'b', u'c'], False)
+    >>> with _EngineCtx(eng):
+    ...     n = update('create table o (id int primary key, `order` int)')
+    ...     r = bulk_load('o', [dict(id=1, order=6)])
+    ...     orders = select_column('select `order` from o')
+    >>> r.rows, orders
+    (1, [6])
+    >>> os.remove(src), os.remove(path)
+    (None, None)
+    """
+    if method not in ('auto', 'load_data', 'executemany'):
+        raise DBError('Unknown bulk load method: %s' % method)
+    global _db_ctx
+    start = time.time()
+    # 文件路径的source打开的文件，导入结束后关闭
+    opened = []
+    try:
+        columns, rows = _source_rows(source, columns, format, header, opened)
+        eng = _db_ctx.engine if _db_ctx.engine is not None else engine
+        loaded = expected = 0
+        used = method
+        with transaction():
+            if method == 'auto' and eng.local_infile is None:
+                # 用一个空文件试探LOAD DATA LOCAL INFILE是否可用，结果记在engine上
+                try:
+                    _bulk_load_infile(table, columns, ())
+                    eng.local_infile = True
+                except Exception as e:
+                    if not _local_infile_unsupported(e):
+                        raise
+                    logger.warning('load data local infile is not available (%s), fall back to executemany.', e)
+                    eng.local_infile = False
+            if method == 'load_data' or (method == 'auto' and eng.local_infile):
+                used = 'load_data'
+                loaded, expected = _bulk_load_infile(table, columns, rows)
+            else:
+                used = 'executemany'
+                sql = 'insert into %s (%s) values (%s)' % (
+                    _quote_name(table), ','.join(_quote_name(col) for col in columns), ','.join(['?'] * len(columns)))
+                while True:
+                    chunk = list(itertools.islice(rows, chunk_size))
+                    if not chunk:
+                        break
+                    expected += len(chunk)
+                    loaded += max(update_many(sql, chunk), 0)
+                    if progress is not None:
+                        progress(loaded)
+            if used == 'load_data' and progress is not None:
+                progress(loaded)
+            if validate and loaded != expected:
+                raise DBError('Bulk load into %s expects %d rows but %d were loaded.' % (table, expected, loaded))
+    finally:
+        for fp in reversed(opened):
+            fp.close()
+    _profiling(start, 'bulk load %d rows into %s by %s' % (loaded, table, used))
+    return Dict(rows=loaded, method=used)
 
 
 class _TransactionCtx(object):
@@ -438,75 +3503,614 @@ class _TransactionCtx(object):
             _db_ctx.init()
             self.should_close_conn = True
         _db_ctx.transactions += 1
-        logging.info('begin transaction...' if _db_ctx.transactions == 1 else 'join current transaction...')
+        logger.debug('begin transaction...' if _db_ctx.transactions == 1 else 'join current transaction...')
         return self
 
     def __exit__(self, exc_type, exc_value, exc_tb):
         exception_logging(exc_type, exc_value, exc_tb, "_TransactionCtx.__exit__")
         global _db_ctx
-        # _db_ctx.transactions = _db_ctx.transactions - 1
-        _db_ctx.transactions -= 1
+        failed = exc_type is not None
         try:
-            if _db_ctx.transactions == 0:
-                if exc_type is None:
-                    self.commit()
-                else:
-                    self.rollback()
+            # 提交前的回调（如orm的flush）在事务内执行，失败时回滚
+            if _db_ctx.transactions == 1 and not failed and _db_ctx.before_commit:
+                failed = True
+                self.run_before_commit()
+                failed = False
         finally:
-            if self.should_close_conn:
-                _db_ctx.cleanup()
-            logging.info('end transaction...')
+            # _db_ctx.transactions = _db_ctx.transactions - 1
+            _db_ctx.transactions -= 1
+            try:
+                if _db_ctx.transactions == 0:
+                    if failed:
+                        self.rollback()
+                    else:
+                        self.commit()
+            finally:
+                if self.should_close_conn:
+                    _db_ctx.cleanup()
+                logger.debug('end transaction...')
+
+    @staticmethod
+    def run_before_commit():
+        global _db_ctx
+        hooks, _db_ctx.before_commit = _db_ctx.before_commit, []
+        for hook in hooks:
+            hook()
 
     @staticmethod
     def commit():
         global _db_ctx
-        logging.info('commit transaction...')
+        logger.debug('commit transaction...')
+        tables, _db_ctx.invalidations = _db_ctx.invalidations, set()
+        _db_ctx.tx_state = {}
+        _db_ctx.before_commit = []
         try:
             _db_ctx.connection.commit()
-            logging.info('commit ok.')
+            logger.debug('commit ok.')
         except:
-            logging.warning('commit failed. try rollback...')
+            logger.warning('commit failed. try rollback...')
             _db_ctx.connection.rollback()
-            logging.warning('rollback ok.')
+            logger.warning('rollback ok.')
             raise
+        if tables and _result_cache is not None:
+            _result_cache.invalidate(tables)
 
     @staticmethod
     def rollback():
         global _db_ctx
-        logging.warning('rollback transaction...')
+        logger.warning('rollback transaction...')
+        _db_ctx.invalidations = set()
+        _db_ctx.tx_state = {}
+        _db_ctx.before_commit = []
         _db_ctx.connection.rollback()
-        logging.info('rollback ok.')
+        logger.info('rollback ok.')
 
 
-def transaction():
-    return _TransactionCtx()
+# 死锁（1213）和锁等待超时（1205）时重做整个事务
+_RETRYABLE_ERRORS = (1205, 1213)
+_retry_stats = {}
+_retry_lock = threading.Lock()
 
 
-def with_transaction(func):
-    start = time.time()
+def _is_retryable(e):
+    return getattr(e, 'errno', None) in _RETRYABLE_ERRORS
+
+
+def _count_retry(site, key):
+    with _retry_lock:
+        counters = _retry_stats.get(site)
+        if counters is None:
+            counters = _retry_stats[site] = Dict(calls=0, conflicts=0, retries=0, failures=0)
+        counters[key] += 1
+
+
+class _TransactionAttempt(_TransactionCtx):
+    """
+    可重试事务的一次尝试：可重试的错误在回滚后被吞掉，由_RetryingTransactionCtx重做
+    """
+    def __init__(self, site, last):
+        self.site = site
+        self.last = last
+        self.retry = False
+
+    def __enter__(self):
+        # 嵌套在外层事务中时由外层事务重试
+        self.nested = _db_ctx.transactions > 0
+        return _TransactionCtx.__enter__(self)
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        try:
+            _TransactionCtx.__exit__(self, exc_type, exc_value, exc_tb)
+        except Exception as e:
+            # 提交时的死锁
+            if self._should_retry(e):
+                return True
+            raise
+        return exc_value is not None and self._should_retry(exc_value)
+
+    def _should_retry(self, e):
+        if self.nested or not _is_retryable(e):
+            return False
+        _count_retry(self.site, 'conflicts')
+        if self.last:
+            _count_retry(self.site, 'failures')
+            logger.warning('transaction at %s gave up after conflict: %s', self.site, e)
+            return False
+        self.retry = True
+        return True
+
+
+class _RetryingTransactionCtx(object):
+    """
+    transaction(retries=N)返回的对象，迭代得到每次尝试的事务：
+    for tx in transaction(retries=3):
+        with tx:
+            ...
+    with块遇到死锁或锁等待超时时回滚，退避后进入下一次迭代重做；成功或遇到其他错误时结束。
+
+    >>> class Deadlock(Exception):
+    ...     errno = 1213
+    >>> class Conn(_SqliteConnection):
+    ...     commit_conflicts = 0
+    ...     def commit(self):
+    ...         if Conn.commit_conflicts:
+    ...             Conn.commit_conflicts -= 1
+    ...             raise Deadlock('deadlock at commit')
+    ...         self._conn.commit()
+    >>> path = tempfile.mktemp()
+    >>> eng = _Engine(lambda: Conn(path))
+    >>> attempts = []
+    >>> @with_transaction(retries=2, backoff=0)
+    ... def move(conflicts):
+    ...     attempts.append(select_int('select count(*) from t'))
+    ...     n = update('insert into t values (?)', len(attempts))
+    ...     if len(attempts) <= conflicts:
+    ...         raise Deadlock('deadlock')
+    ...     return len(attempts)
+    >>> stats = retry_stats(reset=True)
+    >>> with _EngineCtx(eng):
+    ...     n = update('create table t (id int)')
+
+    冲突时回滚并重新执行整个函数：
+    >>> with _EngineCtx(eng):
+    ...     r = move(2)
+    ...     n = select_int('select count(*) from t')
+    >>> r, attempts, n
+    (3, [0, 0, 0], 1)
+    >>> sorted(retry_stats().values()[0].items())
+    [('calls', 1), ('conflicts', 2), ('failures', 0), ('retries', 2)]
+
+    最后一次尝试仍冲突时抛出该异常：
+    >>> del attempts[:]
+    >>> with _EngineCtx(eng):
+    ...     move(5)
+    Traceback (most recent call last):
+      ...
+    Deadlock: deadlock
+    >>> len(attempts), sorted(retry_stats().values()[0].items())
+    (3, [('calls', 2), ('conflicts', 5), ('failures', 1), ('retries', 4)])
+
+    嵌套在外层事务中时不单独重试，由外层事务处理：
+    >>> del attempts[:]
+    >>> with _EngineCtx(eng):
+    ...     with transaction():
+    ...         move(1)
+    Traceback (most recent call last):
+      ...
+    Deadlock: deadlock
+    >>> len(attempts)
+    1
+
+    提交时的死锁同样重试：
+    >>> del attempts[:]
+    >>> Conn.commit_conflicts = 1
+    >>> with _EngineCtx(eng):
+    ...     r = move(0)
+    ...     n = select_int('select count(*) from t')
+    >>> r, attempts, n
+    (2, [1, 1], 2)
+
+    可重试事务不能直接用于with：
+    >>> with transaction(retries=2):  # doctest: +IGNORE_EXCEPTION_DETAIL
+    ...     pass
+    Traceback (most recent call last):
+      ...
+    DBError: A retrying transaction cannot be re-run by with.
+    >>> os.remove(path)
+    """
+    def __init__(self, retries, backoff, max_backoff, site):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.site = site
+
+    def __iter__(self):
+        _count_retry(self.site, 'calls')
+        for attempt in xrange(self.retries + 1):
+            tx = _TransactionAttempt(self.site, attempt == self.retries)
+            yield tx
+            if not tx.retry:
+                return
+            _count_retry(self.site, 'retries')
+            # full jitter的指数退避，避免冲突的事务同时重试
+            time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+
+    def run(self, func, *args, **kw):
+        """
+        在可重试事务中执行func，冲突时重新执行整个func
+        :return: func的返回值
+        """
+        for tx in self:
+            with tx:
+                r = func(*args, **kw)
+        return r
+
+    def __enter__(self):
+        raise DBError('A retrying transaction cannot be re-run by with; use "for tx in transaction(retries=N): with tx:"'
+                      ' or @with_transaction(retries=N).')
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        pass
+
+
+def transaction(retries=0, backoff=0.05, max_backoff=1.0):
+    """
+    :param retries: 大于0时返回可重试的事务（见_RetryingTransactionCtx），死锁或锁等待超时时最多重做retries次
+    :param backoff: 第一次重试前最长等待的秒数，之后每次翻倍
+    :param max_backoff: 每次重试前最长等待的秒数
+    :return: _TransactionCtx或_RetryingTransactionCtx
+    """
+    if not retries:
+        return _TransactionCtx()
+    frame = sys._getframe(1)
+    site = '%s:%d' % (frame.f_code.co_filename, frame.f_lineno)
+    return _RetryingTransactionCtx(retries, backoff, max_backoff, site)
+
+
+def retry_stats(reset=False):
+    """
+    可重试事务按调用位置（文件:行号，或被装饰的函数名）统计的次数
+    :return: Dict，调用位置 -> Dict(calls, conflicts, retries, failures)
+    """
+    with _retry_lock:
+        result = Dict()
+        for site, counters in _retry_stats.iteritems():
+            result[site] = Dict(**counters)
+        if reset:
+            _retry_stats.clear()
+    return result
+
+
+def transaction_state():
+    """
+    :return: 当前最外层事务内有效的dict，供上层模块保存事务范围的状态；不在事务中时返回None
+    """
+    global _db_ctx
+    if _db_ctx.transactions == 0:
+        return None
+    return _db_ctx.tx_state
+
+
+def before_commit(func):
+    """
+    注册在当前最外层事务提交前（仍在事务内）执行的回调，回调抛出异常时事务回滚
+    :param func: 无参数的callable
+    :return: func
+    """
+    global _db_ctx
+    if _db_ctx.transactions == 0:
+        raise DBError("before_commit() must be called inside a transaction.")
+    _db_ctx.before_commit.append(func)
+    return func
+
+
+def with_transaction(func=None, retries=0, backoff=0.05, max_backoff=1.0):
+    """
+    @with_transaction或@with_transaction(retries=3)，参数见transaction()，重试时重新执行整个函数
+    """
+    if func is None:
+        return lambda f: with_transaction(f, retries, backoff, max_backoff)
+    site = '%s.%s' % (func.__module__, func.__name__)
 
     @functools.wraps(func)
     def wrapper(*args, **kw):
-        with transaction():
-            func(*args, **kw)
-        _profiling(start)
+        # start必须在每次调用时取，而不是在装饰时
+        start = time.time()
+        if retries:
+            r = _RetryingTransactionCtx(retries, backoff, max_backoff, site).run(func, *args, **kw)
+        else:
+            with transaction():
+                r = func(*args, **kw)
+        _profiling(start, 'transaction <%s>' % func.__name__)
+        return r
     return wrapper
 
 
+# 异步接口：在有界线程池上执行阻塞的db调用，返回concurrent.futures的future，
+# 调用方使用future.result()、add_done_callback()，或在tornado的coroutine中直接yield
+_async_executor = None
+_async_lock = threading.Lock()
+
+
+def init_async(max_workers=None):
+    """
+    初始化异步接口的线程池，线程数即异步调用最多同时占用的连接数
+    :param max_workers: 默认为engine连接池的pool_size + max_overflow
+    :return: None
+    """
+    global _async_executor
+    if futures is None:
+        raise DBError("Async api requires concurrent.futures (pip install futures on python 2).")
+    if engine is None:
+        raise DBError("Engine is not initialized.")
+    with _async_lock:
+        if _async_executor is not None:
+            raise DBError("Async api is already initialized.")
+        if max_workers is None:
+            max_workers = engine.pool_stats().pool_size + engine.pool_stats().max_overflow
+        _async_executor = futures.ThreadPoolExecutor(max(max_workers, 1))
+
+
+def shutdown_async(wait=True):
+    global _async_executor
+    with _async_lock:
+        executor, _async_executor = _async_executor, None
+    if executor is not None:
+        executor.shutdown(wait)
+
+
+def _get_async_executor():
+    if _pid != os.getpid():
+        # fork出的子进程中没有父进程线程池的线程，先重建
+        _after_fork()
+    if _async_executor is None:
+        init_async()
+    return _async_executor
+
+
+def _run_job(future, func, args, kw):
+    if not future.set_running_or_notify_cancel():
+        return
+    try:
+        result = func(*args, **kw)
+    except BaseException as e:
+        future.set_exception(e)
+    else:
+        future.set_result(result)
+
+
+class _AsyncTransactionCtx(object):
+    """
+    异步事务：从线程池中独占一个线程，事务中的所有语句按顺序在该线程上执行，
+    因此沿用线程局部的_db_ctx和_TransactionCtx的嵌套语义。
+    tx = db.atransaction()
+    yield tx.begin()
+    yield tx.update(...)             # 事务中的语句通过tx调用，aupdate()等不会加入事务
+    yield tx.commit()
+    begin()/commit()/rollback()和各语句都返回future。
+    必须调用commit()或rollback()，否则独占的线程不会释放。
+    """
+    def __init__(self):
+        self._queue = Queue.Queue()
+        self._ctx = None
+        self._started = False
+
+    def _serve(self):
+        # 运行在独占的线程上，直到收到None
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            _run_job(*job)
+
+    def submit(self, func, *args, **kw):
+        f = futures.Future()
+        self._queue.put((f, func, args, kw))
+        return f
+
+    def _begin(self):
+        self._ctx = _TransactionCtx()
+        self._ctx.__enter__()
+        return self
+
+    def _end(self, exc_type, exc_value, exc_tb):
+        ctx, self._ctx = self._ctx, None
+        if ctx is not None:
+            ctx.__exit__(exc_type, exc_value, exc_tb)
+
+    def begin(self):
+        if self._started:
+            raise DBError("Transaction is already started.")
+        self._started = True
+        _get_async_executor().submit(self._serve)
+        return self.submit(self._begin)
+
+    def end(self, exc_type=None, exc_value=None, exc_tb=None):
+        f = self.submit(self._end, exc_type, exc_value, exc_tb)
+        self._queue.put(None)
+        return f
+
+    def commit(self):
+        return self.end()
+
+    def rollback(self):
+        return self.end(DBError, DBError('Transaction rolled back.'), None)
+
+    def select(self, sql, *args, **kw):
+        return self.submit(select, sql, *args, **kw)
+
+    def select_one(self, sql, *args, **kw):
+        return self.submit(select_one, sql, *args, **kw)
+
+    def select_int(self, sql, *args, **kw):
+        return self.submit(select_int, sql, *args, **kw)
+
+    def update(self, sql, *args):
+        return self.submit(update, sql, *args)
+
+    def insert(self, table, **kw):
+        return self.submit(insert, table, **kw)
+
+
+def atransaction():
+    """
+    异步事务，用法见_AsyncTransactionCtx
+    :return: _AsyncTransactionCtx
+
+    >>> module = sys.modules[__name__]
+    >>> path = tempfile.mktemp()
+    >>> saved, module.engine = module.engine, _Engine(_sqlite_connect(path))
+    >>> aupdate('create table t (id int primary key, v int)').result()
+    -1
+    >>> ainsert('t', id=1, v=10).result()
+    1
+    >>> [r.v for r in aselect('select * from t').result()]
+    [10]
+    >>> tx = atransaction()
+    >>> tx.begin().result() is tx
+    True
+    >>> tx.update('update t set v=? where id=?', 0, 1).result(), tx.select_int('select v from t').result()
+    (1, 0)
+    >>> tx.rollback().result()
+    >>> aselect_int('select v from t where id=?', 1).result()
+    10
+    >>> tx = atransaction()
+    >>> tx.begin().result() and tx.insert('t', id=2, v=20).result()
+    1
+    >>> tx.commit().result()
+    >>> aselect_int('select count(*) from t').result()
+    2
+    >>> shutdown_async()
+    >>> module.engine = saved
+    >>> os.remove(path)
+    """
+    if futures is None:
+        raise DBError("Async api requires concurrent.futures (pip install futures on python 2).")
+    return _AsyncTransactionCtx()
+
+
+def _async_call(func, *args, **kw):
+    """
+    :return: 在线程池上执行func(*args, **kw)的future
+    """
+    return _get_async_executor().submit(func, *args, **kw)
+
+
+def aselect(sql, *args, **kw):
+    return _async_call(select, sql, *args, **kw)
+
+
+def aselect_one(sql, *args, **kw):
+    return _async_call(select_one, sql, *args, **kw)
+
+
+def aselect_int(sql, *args, **kw):
+    return _async_call(select_int, sql, *args, **kw)
+
+
+def aupdate(sql, *args):
+    return _async_call(update, sql, *args)
+
+
+def ainsert(table, **kw):
+    return _async_call(insert, table, **kw)
+
+
+# fork安全：pre-fork服务器的子进程不能使用父进程建立的连接和后台线程
+_pid = os.getpid()
+# 子进程中继承自父进程的连接，保留引用，避免被回收时关闭父进程仍在使用的连接
+_inherited = []
+_fork_prewarm = 0
+
+
+def _engines():
+    engines = [engine] if engine is not None else []
+    engines.extend(r.engine for r in _replicas._replicas)
+    engines.extend(_shards._engines.values())
+    return engines
+
+
+def _after_fork():
+    """
+    在子进程中执行一次：丢弃继承的连接，重建依赖后台线程的功能，按设置预热连接
+    """
+    global _pid, _group_commit, _async_executor
+    if _pid == os.getpid():
+        return
+    _pid = os.getpid()
+    for eng in _engines():
+        eng.reset_after_fork()
+    # fork时当前线程可能正持有惰性连接
+    lazy = _db_ctx.connection
+    if lazy is not None and lazy.connection is not None:
+        _inherited.append(lazy.connection)
+        lazy.connection = None
+    for handler in logger.handlers:
+        if isinstance(handler, _QueueHandler):
+            handler.after_fork()
+    if _group_commit is not None:
+        gc = _group_commit
+        _group_commit = _GroupCommitter(len(gc._threads), gc.max_delay, gc.max_batch)
+    if _async_executor is not None:
+        _async_executor = futures.ThreadPoolExecutor(_async_executor._max_workers)
+    if _fork_prewarm and engine is not None:
+        try:
+            engine.prewarm(_fork_prewarm)
+        except Exception:
+            logger.exception('prewarm connections after fork failed.')
+    logger.info('reset db connections after fork, pid %d.', _pid)
+
+
+def after_fork():
+    """
+    供pre-fork服务器的子进程启动钩子（如gunicorn的post_fork）调用。
+    没有os.register_at_fork时（python 2），不调用也会在子进程第一次取连接、写入（group commit）
+    或异步调用时检测到fork并重置，但预热的连接会推迟到那时建立。
+    :return: None
+
+    子进程中不调用after_fork()，group commit的写入也不会等待父进程的writer线程：
+    >>> import signal
+    >>> module = sys.modules[__name__]
+    >>> path = tempfile.mktemp()
+    >>> saved, module.engine = module.engine, _Engine(_sqlite_connect(path))
+    >>> update('create table t (id int)')
+    -1
+    >>> enable_group_commit()
+    >>> update('insert into t values (1)')
+    1
+    >>> pid = os.fork()
+    >>> if pid == 0:
+    ...     signal.alarm(10)
+    ...     try:
+    ...         update('insert into t values (2)')
+    ...     finally:
+    ...         os._exit(0 if select_int('select count(*) from t') == 2 else 1)
+    >>> os.waitpid(pid, 0)[1]
+    0
+    >>> disable_group_commit()
+    >>> module.engine = saved
+    >>> os.remove(path)
+    """
+    _after_fork()
+
+
+def set_fork_prewarm(n):
+    """
+    fork后在子进程中预先建立n条连接，子进程的第一批请求不必等待建立连接
+    :param n: 连接数，0表示不预热
+    :return: None
+    """
+    global _fork_prewarm
+    _fork_prewarm = n
+
+
+def prewarm(n):
+    """
+    预先在engine的连接池中建立n条空闲连接
+    :return: 空闲连接数
+    """
+    if engine is None:
+        raise DBError("Engine is not initialized.")
+    return engine.prewarm(n)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
 # curs = _LasyConnection().cursor()的写法会导致弱连接（连接可能被垃圾回收），导致报错；应写为2句话
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s  [%(levelname)s] [%(filename)s] [line:%(lineno)d]  %(message)s',
+                        datefmt='%d.%b.%Y %H:%M:%S')
+    set_sql_log('all')
     create_engine('root', 'password', 'test')
 
-    sel = selector(2)
-    sel.init("select * from user")
-    sel2 = selector(1)
-    sel2.init("select * from user")
-    for i in sel:
-        print i
-    del sel
-    for i in sel2:
+    with stream("select * from user", batch=2) as rows:
+        for i in rows:
+            print i
+    for i in stream("select * from user", batch=1).batches():
         print i
-    del sel2
 
     # print update('insert into user (id, name) values (?, ?)', '4', 'John')
     # print select("select * from user")
@@ -4,48 +4,536 @@
 __author__ = 'hlsky'
 
 """
-description: none
+description: orm module, Model的SQL在类定义时由ModelMetaclass一次性生成
 """
 
+import logging
+import collections
+
+import db
+
+logger = logging.getLogger('transwarp.orm')
+logger.addHandler(logging.NullHandler())
+
+
 class Field(object):
-    def __init__(self, name, column_type):
+    # 记录Field的定义顺序，决定列的顺序
+    _count = 0
+
+    def __init__(self, name=None, column_type='varchar(100)', primary_key=False, default=None,
+                 nullable=False, updatable=True, insertable=True):
+        """
+        :param name: 列名，默认与属性名相同
+        :param column_type: 列类型
+        :param primary_key: 是否主键
+        :param default: 默认值，可以是callable
+        :param updatable: 是否出现在update语句中，主键总是不可更新
+        :param insertable: 是否出现在insert语句中
+        """
         self.name = name
         self.column_type = column_type
+        self.primary_key = primary_key
+        self._default = default
+        self.nullable = nullable
+        self.updatable = updatable
+        self.insertable = insertable
+        self._order = Field._count
+        Field._count += 1
+
+    @property
+    def default(self):
+        d = self._default
+        return d() if callable(d) else d
+
     def __str__(self):
-        return '<%s:%s>' % (self.__class__.__name__, self.name)
+        return '<%s:%s,%s,default(%s),%s%s%s>' % (
+            self.__class__.__name__, self.name, self.column_type, self._default,
+            'N' if self.nullable else '', 'U' if self.updatable else '', 'I' if self.insertable else '')
+
 
 class StringField(Field):
-    def __init__(self, name):
-        super(StringField, self).__init__(name, 'varchar(100)')
+    def __init__(self, name=None, **kw):
+        kw.setdefault('default', '')
+        kw.setdefault('column_type', 'varchar(100)')
+        super(StringField, self).__init__(name, **kw)
+
 
 class IntegerField(Field):
-    def __init__(self, name):
-        super(IntegerField, self).__init__(name, 'bigint')
+    def __init__(self, name=None, **kw):
+        kw.setdefault('default', 0)
+        kw.setdefault('column_type', 'bigint')
+        super(IntegerField, self).__init__(name, **kw)
+
+
+class FloatField(Field):
+    def __init__(self, name=None, **kw):
+        kw.setdefault('default', 0.0)
+        kw.setdefault('column_type', 'real')
+        super(FloatField, self).__init__(name, **kw)
+
+
+class BooleanField(Field):
+    def __init__(self, name=None, **kw):
+        kw.setdefault('default', False)
+        kw.setdefault('column_type', 'bool')
+        super(BooleanField, self).__init__(name, **kw)
+
+
+class TextField(Field):
+    def __init__(self, name=None, **kw):
+        kw.setdefault('default', '')
+        kw.setdefault('column_type', 'text')
+        super(TextField, self).__init__(name, **kw)
+
+
+# 类名 -> Model，关系的目标可以先用类名声明
+_models = {}
+
+# preload时每条IN查询最多的key数
+_IN_CHUNK = 500
+
+
+class _Relation(object):
+    """
+    关系声明，不对应表中的列。访问未加载的关系时单独查询一次，
+    find_all(..., preload=[...])则对所有结果每个关系只查询一次（select-in）。
+    """
+    def __init__(self, target, key, chunk_size=_IN_CHUNK):
+        self._target = target
+        self.key = key
+        self.chunk_size = chunk_size
+        self.name = None
+
+    @property
+    def target(self):
+        if isinstance(self._target, basestring):
+            if self._target not in _models:
+                raise TypeError('Unknown model %s in relation %s.' % (self._target, self.name))
+            self._target = _models[self._target]
+        return self._target
+
+    def _select_in(self, column, keys):
+        """
+        按column in (keys)分批查询目标Model
+        """
+        target = self.target
+        keys = list(keys)
+        uow = _session()
+        if uow is not None:
+            # 与find_all一样，先写入未flush的insert和修改
+            uow.flush()
+        results = []
+        for i in xrange(0, len(keys), self.chunk_size):
+            chunk = keys[i:i + self.chunk_size]
+            sql = '%s where `%s` in (%s)' % (target.__select_all__, column, ', '.join('?' * len(chunk)))
+            rows = db.select(sql, *chunk)
+            if uow is None:
+                results.extend(target(d.items()) for d in rows)
+            else:
+                results.extend(uow.load(target(d.items())) for d in rows)
+        return results
+
+
+class BelongsTo(_Relation):
+    """
+    多对一：key为本Model中保存目标主键的字段
+    >>> class Author(Model):
+    ...     id = IntegerField(primary_key=True)
+    >>> class Book(Model):
+    ...     id = IntegerField(primary_key=True)
+    ...     author_id = IntegerField()
+    ...     author = BelongsTo('Author', 'author_id')
+    >>> Book.__relations__['author'].target is Author, Book.__fields__
+    (True, ('id', 'author_id'))
+    """
+    def load(self, models):
+        target = self.target
+        keys = set(m.get_value(self.key) for m in models)
+        keys.discard(None)
+        uow = _session()
+        found = {}
+        if uow is not None:
+            for k in list(keys):
+                model = uow.identity.get((target, k))
+                if model is not None:
+                    found[k] = model
+                    keys.discard(k)
+        if keys:
+            pk = target.__primary_key__
+            for model in self._select_in(target.__mappings__[pk].name, keys):
+                found[model[pk]] = model
+        for m in models:
+            dict.__setitem__(m, self.name, found.get(m.get_value(self.key)))
+
+
+class HasMany(_Relation):
+    """
+    一对多：key为目标Model中保存本Model主键的字段
+    """
+    def load(self, models):
+        target = self.target
+        pk = models[0].__primary_key__
+        groups = dict((m[pk], []) for m in models)
+        for child in self._select_in(target.__mappings__[self.key].name, groups.keys()):
+            groups[child[self.key]].append(child)
+        for m in models:
+            dict.__setitem__(m, self.name, groups[m[pk]])
+
 
 class ModelMetaclass(type):
     def __new__(cls, name, bases, attrs):
-        mapping = ... # 读取cls的Field字段
-        primary_key = ... # 查找primary_key字段
-        __table__ = cls.__talbe__ # 读取cls的__table__字段
+        if name == 'Model':
+            return type.__new__(cls, name, bases, attrs)
+        # 读取cls的Field字段，父类的Field可以被子类覆盖
+        mapping = {}
+        relations = {}
+        for base in bases:
+            mapping.update(getattr(base, '__mappings__', {}))
+            relations.update(getattr(base, '__relations__', {}))
+        for k, v in attrs.items():
+            if isinstance(v, Field):
+                if not v.name:
+                    v.name = k
+                mapping[k] = v
+                attrs.pop(k)
+            elif isinstance(v, _Relation):
+                v.name = k
+                relations[k] = v
+                attrs.pop(k)
+        # 查找primary_key字段
+        pks = [k for k, v in mapping.iteritems() if v.primary_key]
+        if len(pks) != 1:
+            raise TypeError('Model %s must define exactly one primary key, got %d.' % (name, len(pks)))
+        primary_key = pks[0]
+        pk_field = mapping[primary_key]
+        pk_field.nullable = False
+        pk_field.updatable = False
+        __table__ = attrs.get('__table__') or name.lower()
+
+        # 列的顺序与Field的定义顺序一致
+        fields = tuple(sorted(mapping, key=lambda k: mapping[k]._order))
+        insert_fields = tuple(k for k in fields if mapping[k].insertable)
+        update_fields = tuple(k for k in fields if mapping[k].updatable)
+        select_list = ', '.join('`%s` as `%s`' % (mapping[k].name, k) if mapping[k].name != k else '`%s`' % k
+                                for k in fields)
+        pk_where = ' where `%s`=?' % pk_field.name
+
         # 给cls增加一些字段：
-        attrs['__mapping__'] = mapping
-        attrs['__primary_key__'] = __primary_key__
+        attrs['__mappings__'] = mapping
+        attrs['__relations__'] = relations
+        attrs['__primary_key__'] = primary_key
         attrs['__table__'] = __table__
-        return type.__new__(cls, name, bases, attrs)
+        attrs['__fields__'] = fields
+        attrs['__insert_fields__'] = insert_fields
+        attrs['__update_fields__'] = update_fields
+        attrs['__select_all__'] = 'select %s from `%s`' % (select_list, __table__)
+        attrs['__select__'] = attrs['__select_all__'] + pk_where
+        attrs['__insert_columns__'] = tuple(mapping[k].name for k in insert_fields)
+        # 按被修改的字段生成的update语句，flush时使用
+        attrs['__update_sqls__'] = {}
+        attrs['__insert__'] = 'insert into `%s` (%s) values (%s)' % (
+            __table__, ', '.join('`%s`' % mapping[k].name for k in insert_fields), ', '.join('?' * len(insert_fields)))
+        attrs['__update__'] = 'update `%s` set %s%s' % (
+            __table__, ', '.join('`%s`=?' % mapping[k].name for k in update_fields), pk_where)
+        attrs['__delete__'] = 'delete from `%s`%s' % (__table__, pk_where)
+        model = type.__new__(cls, name, bases, attrs)
+        _models[name] = model
+        return model
+
+
+class _UnitOfWork(object):
+    """
+    事务范围的identity map和unit of work：同一事务中按主键加载的对象只有一个实例，
+    insert和修改过的字段在最外层事务提交前按表分组批量写入。
+    >>> import os, tempfile
+    >>> path = tempfile.mktemp()
+    >>> saved, db.engine = db.engine, db._Engine(db._sqlite_connect(path))
+    >>> db.update('create table users (id int primary key, name text, mail text)')
+    -1
+    >>> class User(Model):
+    ...     __table__ = 'users'
+    ...     id = IntegerField(primary_key=True)
+    ...     name = StringField()
+    ...     email = StringField('mail')
+    >>> users = [User(id=1, name='a').insert(), User(id=2, name='b').insert()]
+    >>> calls = []
+    >>> update_many = db.update_many
+    >>> db.update_many = lambda sql, rows: calls.append((sql, rows)) or update_many(sql, rows)
+
+    同一事务中按主键加载的是同一个实例，修改的字段合并为一次update_many，
+    find_all前先写入未flush的insert和修改：
+    >>> with db.transaction():
+    ...     a = User.get(1)
+    ...     same = User.get(1) is a
+    ...     a.name = 'x'
+    ...     User.get(2).name = 'y'
+    ...     c = User(id=3, name='c').insert()
+    ...     names = [u.name for u in User.find_all('id > ? order by id', 1)]
+    >>> same, names
+    (True, ['y', 'c'])
+    >>> calls
+    [('update `users` set `name`=? where `id`=?', [['x', 1], ['y', 2]])]
+
+    回滚时丢弃事务中的全部修改：
+    >>> try:
+    ...     with db.transaction():
+    ...         User.get(1).name = 'z'
+    ...         d = User(id=4).insert()
+    ...         n = len(User.find_all())
+    ...         raise ValueError
+    ... except ValueError:
+    ...     pass
+    >>> n, User.get(1).name, User.get(4)
+    (4, u'x', None)
+    >>> db.update_many = update_many
+    >>> db.engine = saved
+    >>> os.remove(path)
+    """
+    def __init__(self):
+        # (cls, pk) -> model
+        self.identity = {}
+        # 待insert的model
+        self.new = []
+        # id(model) -> model，待update的model，修改过的字段记录在model._dirty中
+        self.dirty = collections.OrderedDict()
+
+    def load(self, model):
+        """
+        :return: identity map中已有的实例，或纳入管理的model
+        """
+        key = (model.__class__, model[model.__primary_key__])
+        existing = self.identity.get(key)
+        if existing is not None:
+            return existing
+        self.identity[key] = model
+        model.__dict__['_uow'] = self
+        model.__dict__['_dirty'] = set()
+        return model
+
+    def add(self, model):
+        self.identity[(model.__class__, model[model.__primary_key__])] = model
+        model.__dict__['_uow'] = self
+        # 新对象的字段在flush时整体写入，不需要记录修改
+        model.__dict__['_dirty'] = None
+        self.new.append(model)
+
+    def touch(self, model, fields):
+        dirty = model.__dict__.get('_dirty')
+        if dirty is None:
+            if model.__dict__.get('_uow') is self:
+                return
+            model.__dict__['_uow'] = self
+            model.__dict__['_dirty'] = dirty = set()
+        dirty.update(f for f in fields if f in model.__mappings__ and model.__mappings__[f].updatable)
+        if dirty:
+            self.dirty[id(model)] = model
+
+    def discard(self, model):
+        self.identity.pop((model.__class__, model[model.__primary_key__]), None)
+        self.dirty.pop(id(model), None)
+        model.__dict__.pop('_uow', None)
+        model.__dict__.pop('_dirty', None)
+
+    def flush(self):
+        new, self.new = self.new, []
+        dirty, self.dirty = self.dirty, collections.OrderedDict()
+        inserts = collections.OrderedDict()
+        for model in new:
+            inserts.setdefault(model.__class__, []).append(model)
+        for cls, models in inserts.iteritems():
+            rows = [tuple(m[k] for k in cls.__insert_fields__) for m in models]
+            db.insert_many(cls.__table__, rows, columns=cls.__insert_columns__)
+            for m in models:
+                m.__dict__['_dirty'] = set()
+        updates = collections.OrderedDict()
+        for model in dirty.itervalues():
+            fields = tuple(f for f in model.__update_fields__ if f in model._dirty)
+            updates.setdefault((model.__class__, fields), []).append(model)
+            model._dirty.clear()
+        for (cls, fields), models in updates.iteritems():
+            pk = cls.__primary_key__
+            db.update_many(cls._update_sql(fields), [[m.get_value(f) for f in fields] + [m[pk]] for m in models])
+        if new or dirty:
+            logger.debug('flush %d inserts, %d updates.', len(new), len(dirty))
+
+
+def _session(create=True):
+    """
+    :return: 当前事务的_UnitOfWork，不在事务中时返回None
+    """
+    state = db.transaction_state()
+    if state is None:
+        return None
+    uow = state.get('orm')
+    if uow is None and create:
+        uow = state['orm'] = _UnitOfWork()
+        db.before_commit(uow.flush)
+    return uow
+
+
+class _ClassGet(object):
+    """
+    Model.get(pk)按主键查询；在实例上调用get时仍是dict.get
+    """
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self.func.__get__(cls, type(cls))
+        return dict.get.__get__(obj, cls)
 
 
 # TODO: 换成有序Dict
 class Model(dict):
+    """
+    >>> class User(Model):
+    ...     __table__ = 'users'
+    ...     id = IntegerField(primary_key=True)
+    ...     name = StringField()
+    ...     email = StringField('mail')
+    >>> User.__fields__
+    ('id', 'name', 'email')
+    >>> User.__select__
+    'select `id`, `name`, `mail` as `email` from `users` where `id`=?'
+    >>> User.__insert__
+    'insert into `users` (`id`, `name`, `mail`) values (?, ?, ?)'
+    >>> User.__update__
+    'update `users` set `name`=?, `mail`=? where `id`=?'
+    >>> User.__delete__
+    'delete from `users` where `id`=?'
+    >>> User(id=1, name='Bob').get('name')
+    'Bob'
+    """
     __metaclass__ = ModelMetaclass
 
-    def __init__(self, **kw):
-        super(Model, self).__init__(**kw)
-
     def __getattr__(self, key):
         try:
             return self[key]
         except KeyError:
-            raise AttributeError(r"'Dict' object has no attribute '%s'" % key)
+            relation = self.__relations__.get(key)
+            if relation is None:
+                raise AttributeError(r"'Dict' object has no attribute '%s'" % key)
+        # 未preload的关系单独加载
+        relation.load([self])
+        return self[key]
 
     def __setattr__(self, key, value):
-        self[key] = value
\ No newline at end of file
+        self[key] = value
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        uow = self.__dict__.get('_uow')
+        if uow is not None and uow is _session(False):
+            uow.touch(self, (key,))
+
+    @classmethod
+    def _update_sql(cls, fields):
+        sql = cls.__update_sqls__.get(fields)
+        if sql is None:
+            sql = cls.__update_sqls__[fields] = 'update `%s` set %s where `%s`=?' % (
+                cls.__table__, ', '.join('`%s`=?' % cls.__mappings__[f].name for f in fields),
+                cls.__mappings__[cls.__primary_key__].name)
+        return sql
+
+    @_ClassGet
+    def get(cls, pk):
+        """
+        按主键查询，找不到返回None。事务中已加载的主键直接返回同一个实例。
+        """
+        uow = _session()
+        if uow is not None:
+            model = uow.identity.get((cls, pk))
+            if model is not None:
+                return model
+        d = db.select_one(cls.__select__, pk)
+        if not d:
+            return None
+        if uow is not None:
+            return uow.load(cls(d.items()))
+        return cls(d.items())
+
+    @classmethod
+    def find_all(cls, where=None, *args, **kw):
+        """
+        :param where: where子句（不含where关键字），可带order by/limit
+        :param args: sql参数
+        :param kw: preload，要一并加载的关系名列表，每个关系只执行一次（按key数分批的）IN查询
+        :return: list
+        """
+        preload = kw.pop('preload', None)
+        if kw:
+            raise TypeError('unexpected keyword arguments: %s' % ', '.join(kw.keys()))
+        sql = cls.__select_all__ if where is None else '%s where %s' % (cls.__select_all__, where)
+        uow = _session()
+        if uow is None:
+            models = [cls(d.items()) for d in db.select(sql, *args)]
+        else:
+            # 先写入未flush的修改，查询结果才与事务中的对象一致
+            uow.flush()
+            models = [uow.load(cls(d.items())) for d in db.select(sql, *args)]
+        if preload:
+            cls.preload(models, preload)
+        return models
+
+    @classmethod
+    def preload(cls, models, names):
+        """
+        为已查询出的models批量加载关系
+        :param models: cls的实例列表
+        :param names: 关系名列表
+        :return: models
+        """
+        for name in names:
+            relation = cls.__relations__.get(name)
+            if relation is None:
+                raise AttributeError('%s has no relation %s.' % (cls.__name__, name))
+            if models:
+                relation.load(models)
+        return models
+
+    def insert(self):
+        """
+        事务中推迟到提交前批量insert
+        """
+        mappings = self.__mappings__
+        for k in self.__insert_fields__:
+            if k not in self:
+                dict.__setitem__(self, k, mappings[k].default)
+        uow = _session()
+        if uow is not None:
+            uow.add(self)
+            return self
+        db.update(self.__insert__, *[self[k] for k in self.__insert_fields__])
+        return self
+
+    def update(self):
+        """
+        事务中推迟到提交前批量update；由事务加载的对象只update修改过的字段
+        """
+        uow = _session()
+        if uow is not None:
+            if self.__dict__.get('_uow') is not uow:
+                uow.touch(self, self.__update_fields__)
+            return self
+        args = [self.get_value(k) for k in self.__update_fields__]
+        args.append(self[self.__primary_key__])
+        db.update(self.__update__, *args)
+        return self
+
+    def delete(self):
+        uow = _session(False)
+        if uow is not None:
+            uow.flush()
+            uow.discard(self)
+        db.update(self.__delete__, self[self.__primary_key__])
+        return self
+
+    def get_value(self, key):
+        """
+        未赋值的字段取Field的默认值
+        """
+        if key in self:
+            return self[key]
+        return self.__mappings__[key].default